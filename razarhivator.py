@@ -1,27 +1,70 @@
 import os
 import logging
 import asyncio
+import contextlib
+import contextvars
+import functools
+import heapq
 import subprocess
 import uuid
 import shutil
 import time
+import io
+import math
+from collections import Counter, deque
 import json
+import gzip
+import bz2
+import lzma
+import tarfile
+import zipfile
 import hmac
 import hashlib
+import base64
+import binascii
+import random
+import re
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+import aiohttp
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command, StateFilter
 from pathlib import Path
 from pyunpack import Archive
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, BufferedInputFile, FSInputFile
 from datetime import datetime, timedelta
 import stripe
 
+try:
+    from Crypto.Cipher import AES
+except ImportError:  # без pycryptodome доступна только загрузка через megatools/megadl
+    AES = None
+
+# Текущий спан трассировки (см. span); его trace_id попадает в каждую строку лога
+_current_span = contextvars.ContextVar("current_span", default=None)
+_default_record_factory = logging.getLogRecordFactory()
+
+def _trace_record_factory(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    current = _current_span.get()
+    record.trace = f"[{current.trace_id[:8]}] " if current else ""
+    return record
+
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+logging.setLogRecordFactory(_trace_record_factory)
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(trace)s%(message)s")
 
 # Получаем токены и настройки из переменных окружения
 API_TOKEN = os.getenv("BOT_TOKEN")
@@ -35,6 +78,14 @@ MAX_UNPACK_BYTES = int(os.getenv("MAX_UNPACK_BYTES", "0"))  # 0 = без огр
 # Количество бесплатных дней триала (0 = без триала)
 STRIPE_TRIAL_DAYS = int(os.getenv("STRIPE_TRIAL_DAYS", "0"))
 
+# Напоминание о продлении за столько секунд до окончания подписки (0 = не напоминать)
+LICENSE_REMINDER_BEFORE = int(os.getenv("LICENSE_REMINDER_BEFORE", str(3 * 24 * 60 * 60)))
+# Не больше стольких напоминаний в секунду (лимиты Telegram)
+LICENSE_REMINDER_RATE = max(float(os.getenv("LICENSE_REMINDER_RATE", "20")), 0.1)
+# О конце грейс-периода сообщаем, только если он истёк не раньше стольких секунд назад;
+# более старые (например, накопившиеся, пока бот не работал) снимаются молча
+LICENSE_LAPSE_NOTIFY_WINDOW = int(os.getenv("LICENSE_LAPSE_NOTIFY_WINDOW", str(24 * 60 * 60)))
+
 # Секретный токен для Telegram webhook
 TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 
@@ -45,11 +96,883 @@ def _base_url() -> str:
         url = "https://" + url
     return url.rstrip('/')
 
+# Ключ подписи ссылок на скачивание. По умолчанию выводится из BOT_TOKEN,
+# поэтому одинаков на всех инстансах и не меняется при рестарте.
+DOWNLOAD_SIGNING_KEY = (
+    os.getenv("DOWNLOAD_SIGNING_KEY")
+    or hashlib.sha256(b"download-links:" + (API_TOKEN or "").encode()).hexdigest()
+).encode()
+
+_SHARE_ID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+# compare_digest не сравнивает str с не-ASCII символами, поэтому формат подписи проверяем заранее
+_SIGNATURE_RE = re.compile(r"^[0-9a-f]{32}$")
+
+def _download_signature(user_id: str, share_id: str, expires_ts: int) -> str:
+    msg = f"{user_id}/{share_id}/{expires_ts}".encode()
+    return hmac.new(DOWNLOAD_SIGNING_KEY, msg, hashlib.sha256).hexdigest()[:32]
+
+def make_download_path(user_id: str, share_id: str, expires_ts: int) -> str:
+    """Подписанный путь: срок действия и MAC зашиты в саму ссылку"""
+    return f"/download/{user_id}/{share_id}.{expires_ts}.{_download_signature(user_id, share_id, expires_ts)}"
+
+def verify_download_token(user_id: str, token: str):
+    """Проверяет ссылку без обращения к диску.
+    Возвращает (share_id, None) или (None, (http_status, text)).
+    """
+    try:
+        share_id, expires_str, signature = token.split(".")
+        expires_ts = int(expires_str)
+    except ValueError:
+        return None, (403, "Invalid link")
+    if not user_id.isdigit() or not _SHARE_ID_RE.match(share_id) or not _SIGNATURE_RE.match(signature):
+        return None, (403, "Invalid link")
+    expected = _download_signature(user_id, share_id, expires_ts)
+    if not hmac.compare_digest(expected, signature):
+        return None, (403, "Invalid link")
+    if expires_ts <= int(time.time()):
+        return None, (410, "Link expired")
+    return share_id, None
+
 # Настройка Stripe
 stripe.api_key = STRIPE_SECRET_KEY
 
+# Общая база состояния (FSM, блокировки задач, сроки жизни share-папок).
+# Если положить файл на общий том, её будут видеть все инстансы бота.
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "/data/state.sqlite3")
+# Хранилище FSM: sqlite (переживает рестарт, общее для инстансов) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()
+# Процессы-воркеры: 0 — всё в одном процессе. Иначе этот процесс обслуживает HTTP и Telegram,
+# а задачи выполняют N воркеров; очередь — журнал jobs в STATE_DB_FILE
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+# Как часто воркер проверяет очередь, а задача — флаг отмены в журнале
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+# Long polling Telegram: getUpdates с одним токеном допускает только один инстанс,
+# на остальных (HTTP и воркеры) выставьте TELEGRAM_POLLING=0
+TELEGRAM_POLLING = os.getenv("TELEGRAM_POLLING", "1").strip().lower() not in ("0", "false", "no")
+# Воркер запускается супервизором как `razarhivator.py --worker <n>`
+WORKER_INDEX = int(sys.argv[sys.argv.index("--worker") + 1]) if "--worker" in sys.argv else None
+
+def worker_instance_id(parent_id: str, pid: int) -> str:
+    return f"{parent_id}/worker:{pid}"
+
+# Идентификатор инстанса — владелец блокировок
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+if WORKER_INDEX is not None:
+    INSTANCE_ID = worker_instance_id(INSTANCE_ID, os.getpid())
+# Время жизни блокировки задачи пользователя; живая задача продлевает её каждые TTL/3.
+# Если инстанс упал, после истечения TTL задачу подхватит любой другой.
+JOB_LOCK_TTL = int(os.getenv("JOB_LOCK_TTL", "120"))
+# Как часто ищем прерванные задачи в журнале и сколько хранить завершённые записи
+JOB_RESUME_INTERVAL = int(os.getenv("JOB_RESUME_INTERVAL", "60"))
+JOB_JOURNAL_RETENTION = int(os.getenv("JOB_JOURNAL_RETENTION", str(7 * 24 * 60 * 60)))
+# Сколько ждать завершения задач при остановке, прежде чем сохранить их и выйти
+SHUTDOWN_GRACE = int(os.getenv("SHUTDOWN_GRACE", "20"))
+
+# Загрузчик MEGA: auto (встроенный, при ошибке — megatools), native или megatools
+MEGA_DOWNLOADER = os.getenv("MEGA_DOWNLOADER", "auto").strip().lower()
+# Адрес API MEGA (можно направить на локальный тестовый сервер)
+MEGA_API_URL = os.getenv("MEGA_API_URL", "https://g.api.mega.co.nz/cs")
+# Сколько диапазонов файла качаем одновременно и размер одного диапазона
+MEGA_PARALLEL_RANGES = int(os.getenv("MEGA_PARALLEL_RANGES", "4"))
+MEGA_SEGMENT_BYTES = int(os.getenv("MEGA_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+MEGA_RETRIES = int(os.getenv("MEGA_RETRIES", "5"))
+# Папки MEGA: сколько файлов качаем параллельно и предел размера файла (0 = без ограничений)
+MEGA_FOLDER_PARALLEL = int(os.getenv("MEGA_FOLDER_PARALLEL", "3"))
+MEGA_FOLDER_MAX_FILE_BYTES = int(os.getenv("MEGA_FOLDER_MAX_FILE_BYTES", "0"))
+
+# Что считаем архивами и какие файлы отдаём пользователю.
+# Локальные файлы определяются по сигнатуре, суффиксы нужны там, где содержимого ещё нет (папки MEGA)
+ARCHIVE_SUFFIXES = ('.zip', '.rar', '.7z', '.tar', '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz')
+TARGET_SUFFIXES = ('.json', '.session')
+# Манифест результата (пары .session/.json и отброшенные файлы) кладётся рядом с файлами
+MANIFEST_NAME = "_manifest.json"
+# Потоки для файловой уборки в обработчиках (rmtree, обход каталогов, копирование)
+FS_IO_WORKERS = int(os.getenv("FS_IO_WORKERS", "4"))
+# Потоки для проверки .session/.json (sqlite3 и чтение файлов отпускают GIL)
+VALIDATION_WORKERS = int(os.getenv("VALIDATION_WORKERS", str(min(8, (os.cpu_count() or 1) * 2))))
+# Сколько живёт ссылка на архив и как часто проверяем просроченные папки
+SHARE_TTL = int(os.getenv("SHARE_TTL", str(30 * 60)))
+SHARE_SWEEP_INTERVAL = int(os.getenv("SHARE_SWEEP_INTERVAL", "60"))
+# Результат до этого размера отправляем документом прямо в чат, без ссылки (0 = всегда ссылка).
+# Telegram принимает от ботов документы до 50 МБ.
+DIRECT_DELIVERY_MAX_BYTES = int(os.getenv("DIRECT_DELIVERY_MAX_BYTES", str(10 * 1024 * 1024)))
+# Бюджет CPU на сжатие архивов выдачи: fast (меньше CPU), balanced, max (меньше трафика)
+ARCHIVE_CPU_BUDGET = os.getenv("ARCHIVE_CPU_BUDGET", "balanced").strip().lower()
+# Сюда пишется время сборки и степень сжатия каждого архива (JSONL)
+ARCHIVE_STATS_FILE = os.getenv("ARCHIVE_STATS_FILE", "/data/archive_stats.jsonl")
+# Профилирование по команде админа: куда класть результаты, шаг выборки и предел длительности
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/data/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+# Сколько фронтенд ждёт результаты воркеров после конца своего профилирования
+PROFILE_COLLECT_TIMEOUT = float(os.getenv("PROFILE_COLLECT_TIMEOUT", "30"))
+# Трассировка задач: спаны пишутся в JSONL с ротацией, сводки последних задач держим в памяти для /slowjobs
+TRACE_FILE = os.getenv("TRACE_FILE", "/data/traces.jsonl")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(20 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "3"))
+TRACE_RECENT_JOBS = int(os.getenv("TRACE_RECENT_JOBS", "200"))
+if WORKER_INDEX is not None:
+    # RotatingFileHandler не рассчитан на запись из нескольких процессов — у воркера свой файл
+    _trace_root, _trace_ext = os.path.splitext(TRACE_FILE)
+    TRACE_FILE = f"{_trace_root}.worker{WORKER_INDEX}{_trace_ext}"
+# Токен для /admin/* HTTP-эндпоинтов (заголовок X-Admin-Token). Пустой — эндпоинты выключены
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+
+
+class StateDB:
+    """SQLite-хранилище общего состояния бота.
+    Соединения держим по одному на поток: методы вызываются через asyncio.to_thread.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_ts INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS shares (
+            path TEXT PRIMARY KEY,
+            expires_ts INTEGER NOT NULL,
+            job_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            links TEXT NOT NULL,
+            link_status TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL,
+            workspace TEXT NOT NULL,
+            created_ts INTEGER NOT NULL,
+            updated_ts INTEGER NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            link_message_id INTEGER,
+            trace TEXT,
+            pids TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+        CREATE TABLE IF NOT EXISTS profile_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seconds REAL NOT NULL,
+            created_ts INTEGER NOT NULL,
+            stop_requested INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS profile_results (
+            run_id INTEGER NOT NULL,
+            process TEXT NOT NULL,
+            collapsed TEXT,
+            alloc TEXT,
+            error TEXT,
+            PRIMARY KEY (run_id, process)
+        );
+    """
+    # Колонки, появившиеся после первой версии схемы: добавляем в существующую базу
+    MIGRATIONS = {
+        "shares": {"job_id": "TEXT"},
+        "jobs": {
+            "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+            "worker": "TEXT",
+            "link_message_id": "INTEGER",
+            "trace": "TEXT",
+            "pids": "TEXT",
+        },
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self.connect()
+        conn.executescript(self.SCHEMA)
+        for table, columns in self.MIGRATIONS.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, decl in columns.items():
+                if name in existing:
+                    continue
+                try:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+                except sqlite3.OperationalError as e:
+                    # Колонку мог только что добавить другой процесс
+                    if "duplicate column" not in str(e):
+                        raise
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # FSM
+    def fsm_get(self, key):
+        row = self.connect().execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1] or "{}")
+
+    def fsm_set_state(self, key, state):
+        self.connect().execute(
+            "INSERT INTO fsm(key, state) VALUES(?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (key, state),
+        )
+
+    def fsm_set_data(self, key, data):
+        self.connect().execute(
+            "INSERT INTO fsm(key, data) VALUES(?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (key, json.dumps(data, ensure_ascii=False)),
+        )
+
+    # Блокировки (аренда с TTL: упавший инстанс не держит пользователя вечно)
+    def lock_acquire(self, name, owner, ttl):
+        now = int(time.time())
+        cur = self.connect().execute(
+            "INSERT INTO locks(name, owner, expires_ts) VALUES(?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_ts = excluded.expires_ts "
+            "WHERE locks.expires_ts < ? OR locks.owner = excluded.owner",
+            (name, owner, now + ttl, now),
+        )
+        return cur.rowcount > 0
+
+    def lock_release(self, name, owner):
+        self.connect().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    # Сроки жизни share-папок
+    def share_register(self, path, expires_ts, job_id=None):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO shares(path, expires_ts, job_id) VALUES(?, ?, ?)", (path, expires_ts, job_id)
+        )
+
+    def share_job(self, path):
+        row = self.connect().execute("SELECT job_id FROM shares WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def share_pop_expired(self, now):
+        conn = self.connect()
+        rows = conn.execute("SELECT path FROM shares WHERE expires_ts <= ?", (now,)).fetchall()
+        for (path,) in rows:
+            conn.execute("DELETE FROM shares WHERE path = ?", (path,))
+        return [path for (path,) in rows]
+
+    # Журнал задач
+    def job_save(self, rec):
+        now = int(time.time())
+        self.connect().execute(
+            "INSERT OR REPLACE INTO jobs(job_id, user_id, chat_id, links, link_status, stage, status, "
+            "workspace, created_ts, updated_ts) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                rec["job_id"], rec["user_id"], rec["chat_id"], json.dumps(rec["links"]),
+                json.dumps(rec["link_status"]), rec["stage"], rec["status"], rec["workspace"], now, now,
+            ),
+        )
+
+    def job_update(self, job_id, **fields):
+        for name in ("links", "link_status", "pids"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        fields["updated_ts"] = int(time.time())
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self.connect().execute(
+            f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id)
+        )
+
+    @staticmethod
+    def _job_records(cur):
+        columns = [c[0] for c in cur.description]
+        records = []
+        for row in cur.fetchall():
+            rec = dict(zip(columns, row))
+            rec["links"] = json.loads(rec["links"])
+            rec["link_status"] = json.loads(rec["link_status"])
+            records.append(rec)
+        return records
+
+    def jobs_by_status(self, status):
+        return self._job_records(
+            self.connect().execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_ts", (status,))
+        )
+
+    def jobs_prune(self, before_ts):
+        self.connect().execute(
+            "DELETE FROM jobs WHERE status NOT IN ('running', 'queued') AND updated_ts < ?", (before_ts,)
+        )
+
+    # Очередь задач для процессов-воркеров
+    def job_enqueue(self, rec):
+        """Ставит задачу в очередь, если у пользователя нет другой queued/running задачи"""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            busy = conn.execute(
+                "SELECT 1 FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')", (rec["user_id"],)
+            ).fetchone()
+            if not busy:
+                self.job_save({**rec, "status": "queued"})
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return not busy
+
+    def job_claim(self, worker, ttl):
+        """Забирает самую старую задачу из очереди вместе с арендой пользователя.
+        В записи поле resumed: задачу уже брал другой воркер (её папки чистить нельзя).
+        """
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            claimed = None
+            rows = conn.execute(
+                "SELECT job_id, user_id, worker FROM jobs WHERE status = 'queued' ORDER BY created_ts"
+            ).fetchall()
+            for job_id, user_id, previous in rows:
+                # Занятого пользователя (например, задачей однопроцессного инстанса) пропускаем
+                if self.lock_acquire(f"user:{user_id}", f"{worker}/{job_id}", ttl):
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, updated_ts = ? WHERE job_id = ?",
+                        (worker, int(time.time()), job_id),
+                    )
+                    claimed = job_id, previous is not None
+                    break
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if not claimed:
+            return None
+        job_id, resumed = claimed
+        rec = self._job_records(self.connect().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)))[0]
+        rec["resumed"] = resumed
+        return rec
+
+    def worker_job_pids(self, worker):
+        """Группы внешних процессов (megatools, 7z, unar), запущенных задачами воркера"""
+        rows = self.connect().execute(
+            "SELECT pids FROM jobs WHERE worker = ? AND status = 'running' AND pids IS NOT NULL", (worker,)
+        ).fetchall()
+        return [pid for (pids,) in rows for pid in json.loads(pids)]
+
+    def jobs_requeue_worker(self, worker):
+        """Возвращает в очередь задачи упавшего воркера и снимает его аренды"""
+        conn = self.connect()
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'queued', pids = NULL, updated_ts = ? WHERE worker = ? AND status = 'running'",
+            (int(time.time()), worker),
+        )
+        prefix = f"{worker}/"
+        conn.execute("DELETE FROM locks WHERE substr(owner, 1, ?) = ?", (len(prefix), prefix))
+        return cur.rowcount
+
+    def job_request_cancel(self, user_id):
+        """Отмена из другого процесса: задачу в очереди снимаем сразу, выполняющейся ставим флаг"""
+        conn = self.connect()
+        now = int(time.time())
+        queued = conn.execute(
+            "UPDATE jobs SET status = 'cancelled', links = '[]', updated_ts = ? WHERE user_id = ? AND status = 'queued'",
+            (now, user_id),
+        ).rowcount
+        running = conn.execute(
+            "UPDATE jobs SET cancel_requested = 1, updated_ts = ? "
+            "WHERE user_id = ? AND status = 'running' AND cancel_requested = 0",
+            (now, user_id),
+        ).rowcount
+        return queued + running > 0
+
+    def job_cancel_requested(self, job_id):
+        row = self.connect().execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def pop_link_message(self, user_id):
+        """Последнее сообщение со ссылкой на архив (для кнопки «Удалить архив»), один раз"""
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT job_id, link_message_id FROM jobs WHERE user_id = ? AND link_message_id IS NOT NULL "
+            "ORDER BY updated_ts DESC LIMIT 1",
+            (user_id,),
+        ).fetchone()
+        if not row:
+            return None
+        conn.execute("UPDATE jobs SET link_message_id = NULL WHERE job_id = ?", (row[0],))
+        return row[1]
+
+    def jobs_traced(self, limit):
+        rows = self.connect().execute(
+            "SELECT trace FROM jobs WHERE trace IS NOT NULL ORDER BY updated_ts DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [json.loads(trace) for (trace,) in rows]
+
+    # Профилирование процессов-воркеров: фронтенд создаёт запуск, воркеры пишут результаты
+    def profile_request(self, seconds):
+        conn = self.connect()
+        now = int(time.time())
+        # Старые запуски и их результаты больше никому не нужны
+        conn.execute("DELETE FROM profile_results WHERE run_id IN (SELECT run_id FROM profile_runs WHERE created_ts < ?)",
+                     (now - 24 * 60 * 60,))
+        conn.execute("DELETE FROM profile_runs WHERE created_ts < ?", (now - 24 * 60 * 60,))
+        return conn.execute(
+            "INSERT INTO profile_runs(seconds, created_ts) VALUES(?, ?)", (seconds, now)
+        ).lastrowid
+
+    def profile_request_stop(self, run_id):
+        self.connect().execute("UPDATE profile_runs SET stop_requested = 1 WHERE run_id = ?", (run_id,))
+
+    def profile_run(self, run_id=None):
+        """Запуск по id или последний; None, если запусков не было"""
+        cur = self.connect().execute(
+            "SELECT run_id, seconds, created_ts, stop_requested FROM profile_runs "
+            + ("WHERE run_id = ?" if run_id is not None else "ORDER BY run_id DESC LIMIT 1"),
+            (run_id,) if run_id is not None else (),
+        )
+        row = cur.fetchone()
+        return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+    def profile_result_save(self, run_id, process, collapsed=None, alloc=None, error=None):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO profile_results(run_id, process, collapsed, alloc, error) VALUES(?, ?, ?, ?, ?)",
+            (run_id, process, collapsed, alloc, error),
+        )
+
+    def profile_results(self, run_id):
+        cur = self.connect().execute(
+            "SELECT process, collapsed, alloc, error FROM profile_results WHERE run_id = ? ORDER BY process", (run_id,)
+        )
+        columns = [c[0] for c in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх StateDB"""
+
+    def __init__(self, db: StateDB):
+        self.db = db
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny,
+        )
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self.db.fsm_set_state, self._key(key), value)
+
+    async def get_state(self, key: StorageKey):
+        state, _ = await asyncio.to_thread(self.db.fsm_get, self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await asyncio.to_thread(self.db.fsm_set_data, self._key(key), dict(data))
+
+    async def get_data(self, key: StorageKey):
+        _, data = await asyncio.to_thread(self.db.fsm_get, self._key(key))
+        return data
+
+    async def close(self) -> None:
+        pass
+
+
+class JobLocks:
+    """Распределённая блокировка «одна задача на пользователя»"""
+
+    def __init__(self, db: StateDB, ttl: int = JOB_LOCK_TTL):
+        self.db = db
+        self.ttl = ttl
+
+    async def acquire(self, name: str, owner: str) -> bool:
+        return await asyncio.to_thread(self.db.lock_acquire, name, owner, self.ttl)
+
+    # Повторный захват тем же владельцем продлевает аренду
+    refresh = acquire
+
+    async def release(self, name: str, owner: str) -> None:
+        try:
+            await asyncio.to_thread(self.db.lock_release, name, owner)
+        except Exception as e:
+            logging.error(f"Не удалось снять блокировку {name}: {e}")
+
+
+def _scan_files(root, suffixes=None, recursive=False):
+    """Файлы каталога одним проходом os.scandir: [(path, size)]"""
+    result, stack = [], [str(root)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if suffixes and not entry.name.lower().endswith(suffixes):
+                        continue
+                    result.append((Path(entry.path), entry.stat(follow_symlinks=False).st_size))
+    return result
+
+def _reset_dir(path: Path):
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True, exist_ok=True)
+
+def _copy_files(files, dest_dir: Path) -> int:
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for f in files:
+        shutil.copyfile(f, dest_dir / f.name)
+        total += (dest_dir / f.name).stat().st_size
+    return total
+
+def _move_files(moves):
+    for src, dst in moves:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dst)
+
+def _unlink_matching(root, suffix: str) -> int:
+    removed = 0
+    for path, _ in _scan_files(root, (suffix,), recursive=True):
+        try:
+            path.unlink()
+            removed += 1
+        except OSError as e:
+            logging.warning(f"Не удалось удалить {path}: {e}")
+    return removed
+
+
+class AsyncFS:
+    """Файловые операции обработчиков на отдельном ограниченном пуле потоков.
+    Уборка большого дерева одного пользователя не блокирует цикл событий
+    и не занимает общий пул asyncio.to_thread.
+    """
+
+    def __init__(self, workers: int):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fs")
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # run_in_executor не переносит contextvars — копируем, чтобы спаны попали в трассу задачи
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.pool, functools.partial(ctx.run, func, *args, **kwargs))
+
+    async def rmtree(self, path):
+        await self.run(shutil.rmtree, path, True)
+
+    async def reset_dir(self, path: Path):
+        await self.run(_reset_dir, path)
+
+    async def scan_files(self, root, suffixes=None, recursive=False):
+        return await self.run(_scan_files, root, suffixes, recursive)
+
+    async def copy_files(self, files, dest_dir: Path) -> int:
+        return await self.run(_copy_files, list(files), dest_dir)
+
+    async def move_files(self, moves):
+        await self.run(_move_files, list(moves))
+
+    async def unlink_matching(self, root, suffix: str) -> int:
+        return await self.run(_unlink_matching, root, suffix)
+
+
+# --- Трассировка задач ---
+
+_trace_log = logging.getLogger("razarhivator.trace")
+_trace_log.propagate = False
+try:
+    os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+    _trace_handler = RotatingFileHandler(
+        TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, encoding="utf-8"
+    )
+    _trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_log.addHandler(_trace_handler)
+except OSError as e:
+    logging.warning(f"Трассировка в файл отключена: {e}")
+    _trace_log.addHandler(logging.NullHandler())
+
+
+class Span:
+    """Участок работы: имя, длительность и атрибуты (bytes, files, ...)"""
+
+    def __init__(self, name: str, trace_id: str, parent_id, attrs: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+        self._started = time.monotonic()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def record(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 3),
+            "duration": round(self.duration, 4),
+            "status": self.status,
+            **self.attrs,
+        }
+
+
+class JobTraces:
+    """Сводка по стадиям (суммарное время, число спанов, байты) для последних задач.
+    run_job сохраняет её в журнал jobs — /slowjobs читает оттуда, в том числе сводки воркеров.
+    """
+
+    def __init__(self, limit: int):
+        self._lock = threading.Lock()
+        self._open = {}
+        self.recent = deque(maxlen=limit)
+
+    def begin(self, trace_id: str):
+        with self._lock:
+            self._open[trace_id] = {}
+
+    def add(self, span: Span):
+        # Спаны закрываются и в потоках пулов
+        with self._lock:
+            stages = self._open.get(span.trace_id)
+            if stages is None:
+                return
+            entry = stages.setdefault(span.name, {"seconds": 0.0, "count": 0, "bytes": 0})
+            entry["seconds"] += span.duration
+            entry["count"] += 1
+            entry["bytes"] += span.attrs.get("bytes", 0)
+
+    def end(self, root: Span):
+        with self._lock:
+            stages = self._open.pop(root.trace_id, {})
+        self.recent.append({**root.record(), "stages": stages})
+
+    def summary(self, trace_id: str):
+        for rec in reversed(self.recent):
+            if rec["trace_id"] == trace_id:
+                return rec
+        return None
+
+
+job_traces = JobTraces(TRACE_RECENT_JOBS)
+
+@contextlib.contextmanager
+def span(name: str, trace_id: str = None, **attrs):
+    """Спан внутри текущего (или корневой, если задан trace_id / текущего нет).
+    Контекст наследуют asyncio-задачи и asyncio.to_thread; для run_in_executor
+    его копирует AsyncFS.run.
+    """
+    parent = _current_span.get()
+    if trace_id is None:
+        trace_id = parent.trace_id if parent else uuid.uuid4().hex
+    parent_id = parent.span_id if parent and parent.trace_id == trace_id else None
+    current = Span(name, trace_id, parent_id, attrs)
+    if name == "job":
+        job_traces.begin(trace_id)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except (asyncio.CancelledError, JobCancelled):
+        current.status = "cancelled"
+        raise
+    except BaseException as e:
+        current.status = "error"
+        current.attrs["error"] = str(e)[:200]
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.monotonic() - current._started
+        _trace_log.info(json.dumps(current.record(), ensure_ascii=False, default=str))
+        if name == "job":
+            job_traces.end(current)
+        else:
+            job_traces.add(current)
+
+def trace_set(**attrs):
+    """Дополняет атрибуты текущего спана (если он есть)"""
+    current = _current_span.get()
+    if current:
+        current.set(**attrs)
+
+def stripe_call(op: str, func, *args, **kwargs):
+    """Вызов Stripe API отдельным спаном"""
+    with span("stripe", op=op):
+        return func(*args, **kwargs)
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер всего процесса, включается на время без рестарта.
+    Раз в PROFILE_INTERVAL снимает стеки всех потоков через sys._current_frames():
+    MainThread — цикл событий, fs/validate/asyncio — пулы потоков.
+    Результат — collapsed stacks (flamegraph.pl, speedscope) и топ аллокаций tracemalloc.
+    В режиме WORKER_PROCESSES запуск передаётся воркерам через журнал (profile_runs),
+    а их результаты сводятся в общие файлы (merge_profiles).
+    """
+
+    def __init__(self, label: str):
+        # Метка процесса в именах файлов: на общем PROFILE_DIR пишут и воркеры
+        self.label = label
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.started_at = None
+        self.last_result = None
+        # Запуск в журнале, который выполняют воркеры (только у фронтенда)
+        self.run_id = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, loop: asyncio.AbstractEventLoop):
+        """Запускает профилирование. Возвращает future с путями результатов или None, если уже идёт"""
+        with self._lock:
+            if self.running:
+                return None
+            seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+            future = loop.create_future()
+            self._stop.clear()
+            self.started_at = time.time()
+            self._thread = threading.Thread(
+                target=self._run, args=(seconds, loop, future), name="profiler", daemon=True
+            )
+            self._thread.start()
+            return future
+
+    def stop(self) -> bool:
+        if not self.running:
+            return False
+        self._stop.set()
+        return True
+
+    def _run(self, seconds, loop, future):
+        try:
+            result = self._profile(seconds)
+        except Exception as e:
+            logging.error(f"Ошибка профилирования: {e}")
+            loop.call_soon_threadsafe(future.set_exception, e)
+            return
+        self.last_result = result
+        loop.call_soon_threadsafe(future.set_result, result)
+
+    def _profile(self, seconds):
+        own_tracemalloc = not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(16)
+        own_ident = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline and not self._stop.wait(PROFILE_INTERVAL):
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    parts = []
+                    while frame is not None:
+                        code = frame.f_code
+                        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    # Потоки одного пула сводим в одну ветку: fs_0, fs_1 -> fs
+                    parts.append(re.sub(r"_\d+$", "", names.get(ident, str(ident))))
+                    stacks[";".join(reversed(parts))] += 1
+                samples += 1
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if own_tracemalloc:
+                tracemalloc.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        collapsed_path = Path(PROFILE_DIR) / f"profile-{stamp}-{self.label}.collapsed"
+        alloc_path = Path(PROFILE_DIR) / f"profile-{stamp}-{self.label}.alloc.txt"
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        stats = snapshot.statistics("lineno")
+        with open(alloc_path, "w", encoding="utf-8") as f:
+            if own_tracemalloc:
+                f.write("# Только аллокации, сделанные за время профилирования и ещё живые\n")
+            f.write(f"# samples={samples} interval={PROFILE_INTERVAL}s total={sum(s.size for s in stats)} bytes\n")
+            for stat in stats[:50]:
+                f.write(f"{stat}\n")
+        logging.info(f"Profile written: {collapsed_path} ({samples} samples), {alloc_path}")
+        return collapsed_path, alloc_path
+
+
+def merge_profiles(parts):
+    """Сводит результаты процессов в один .collapsed (стеки с префиксом процесса) и один .alloc.txt.
+    parts: [(process, (collapsed_path, alloc_path) или None, error)]
+    """
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    collapsed_path = Path(PROFILE_DIR) / f"profile-{stamp}-all.collapsed"
+    alloc_path = Path(PROFILE_DIR) / f"profile-{stamp}-all.alloc.txt"
+    with open(collapsed_path, "w", encoding="utf-8") as collapsed, open(alloc_path, "w", encoding="utf-8") as alloc:
+        for process, paths, error in parts:
+            alloc.write(f"## {process}\n")
+            if error or not paths:
+                alloc.write(f"# error: {error or 'no result'}\n\n")
+                continue
+            with open(paths[0], encoding="utf-8") as f:
+                for line in f:
+                    collapsed.write(f"{process};{line}")
+            with open(paths[1], encoding="utf-8") as f:
+                alloc.write(f.read())
+            alloc.write("\n")
+    return collapsed_path, alloc_path
+
+
+def _open_state_db(path: str) -> StateDB:
+    try:
+        return StateDB(path)
+    except (OSError, sqlite3.OperationalError) as e:
+        # Без тома /data бот должен стартовать, как и раньше: база в рабочем каталоге
+        # (переживает рестарт процесса, но не пересоздание контейнера)
+        fallback = os.path.abspath(os.path.basename(path))
+        logging.error(f"Cannot open state DB at {path}: {e}; using {fallback}")
+        return StateDB(fallback)
+
+
+async def _run_to_completion(func, *args):
+    """Как asyncio.to_thread, но при отмене задачи дожидается потока: поток продолжает
+    писать в файлы и папки вызывающего, а тот сразу после отмены их закрывает или удаляет.
+    Сам поток должен проверять отмену (job.check_cancelled), иначе ожидание затянется.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    future = loop.run_in_executor(None, functools.partial(ctx.run, func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        raise
+
+
+state_db = _open_state_db(STATE_DB_FILE)
+job_locks = JobLocks(state_db)
+fs = AsyncFS(FS_IO_WORKERS)
+profiler = SamplingProfiler("main" if WORKER_INDEX is None else f"worker{WORKER_INDEX}-{os.getpid()}")
+
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+storage = SQLiteStorage(state_db) if FSM_STORAGE == "sqlite" else MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Папки для загрузки и выгрузки
@@ -116,7 +1039,8 @@ def load_licenses():
 def save_licenses(data):
     """Сохраняет данные лицензий в JSON файл"""
     try:
-        tmp_path = LICENSES_FILE + ".tmp"
+        # Уникальный tmp-файл: несколько процессов не пишут в один и тот же файл
+        tmp_path = f"{LICENSES_FILE}.{os.getpid()}.tmp"
         base_dir = os.path.dirname(LICENSES_FILE) or "."
         os.makedirs(base_dir, exist_ok=True)
         with open(tmp_path, 'w', encoding='utf-8') as f:
@@ -126,6 +1050,7 @@ def save_licenses(data):
         except Exception:
             pass
         os.replace(tmp_path, LICENSES_FILE)
+        license_scheduler.note_saved()
         try:
             os.chmod(LICENSES_FILE, 0o666)
         except Exception:
@@ -204,7 +1129,9 @@ def update_user_license(user_id, expires_ts, email=None):
         if email:
             licenses["users"][user_id_str]["email"] = email
             
-        return save_licenses(licenses)
+        saved = save_licenses(licenses)
+        license_scheduler.schedule_user(user_id_str, licenses["users"][user_id_str])
+        return saved
     except Exception as e:
         logging.error(f"Ошибка обновления лицензии: {e}")
         return False
@@ -228,6 +1155,163 @@ def get_user_by_subscription(subscription_id):
         logging.error(f"Ошибка получения пользователя по подписке: {e}")
         return None
 
+class LicenseScheduler:
+    """Планировщик сроков подписок.
+    Держит кучу дедлайнов (напоминание до expires_ts, конец grace_until, срок pending_by_email)
+    и просыпается только к ближайшему из них — работа пропорциональна числу наступивших событий.
+    Устаревшие записи кучи не удаляются, а отбрасываются при проверке: событие выполняется,
+    только если значение в лицензиях всё ещё совпадает с запланированным.
+    """
+
+    LOCK_NAME = "scheduler:licenses"
+
+    def __init__(self):
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        # mtime файла лицензий, по которому построена куча, и mtime нашей последней записи
+        self.loaded_mtime = None
+        self.saved_mtime = None
+        # Держит ли этот инстанс аренду планировщика
+        self.leader = False
+
+    @staticmethod
+    def _mtime():
+        try:
+            return os.stat(LICENSES_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+    def note_saved(self):
+        self.saved_mtime = self._mtime()
+
+    def _push_user(self, user_id: str, rec: dict):
+        expires_ts = int(rec.get("expires_ts", 0) or 0)
+        if expires_ts and LICENSE_REMINDER_BEFORE and rec.get("reminded_for") != expires_ts:
+            heapq.heappush(self.heap, (expires_ts - LICENSE_REMINDER_BEFORE, "remind", user_id, expires_ts))
+        grace_until = int(rec.get("grace_until", 0) or 0)
+        if grace_until:
+            heapq.heappush(self.heap, (grace_until, "grace", user_id, grace_until))
+
+    def schedule_user(self, user_id, rec: dict):
+        self._push_user(str(user_id), rec)
+        self.wakeup.set()
+
+    def schedule_pending(self, email: str, expires_ts: int):
+        heapq.heappush(self.heap, (int(expires_ts), "pending", email, int(expires_ts)))
+        self.wakeup.set()
+
+    def rebuild(self):
+        """Полная перестройка — только при старте и если файл изменил другой процесс"""
+        licenses = load_licenses()
+        self.heap = []
+        for user_id, rec in licenses.get("users", {}).items():
+            self._push_user(user_id, rec)
+        for email, expires_ts in licenses.get("pending_by_email", {}).items():
+            self.heap.append((int(expires_ts), "pending", email, int(expires_ts)))
+        heapq.heapify(self.heap)
+        self.loaded_mtime = self._mtime()
+        logging.info(f"License scheduler: {len(self.heap)} deadlines indexed")
+
+    def _apply_due(self, due):
+        """Одна загрузка и одна запись файла на всю пачку событий.
+        Выполняется в цикле событий, как и остальные операции с лицензиями, — без гонок с ними.
+        """
+        licenses = load_licenses()
+        now = int(time.time())
+        reminders, lapsed, changed = [], [], False
+        for _, kind, key, version in due:
+            if kind == "pending":
+                pending = licenses.setdefault("pending_by_email", {})
+                if pending.get(key) == version:
+                    del pending[key]
+                    changed = True
+                continue
+            rec = licenses["users"].get(key)
+            if not rec:
+                continue
+            if kind == "remind":
+                expires_ts = int(rec.get("expires_ts", 0) or 0)
+                if expires_ts == version and expires_ts > now and rec.get("reminded_for") != version:
+                    rec["reminded_for"] = version
+                    reminders.append((key, version))
+                    changed = True
+            elif kind == "grace" and int(rec.get("grace_until", 0) or 0) == version:
+                rec.pop("grace_until", None)
+                changed = True
+                if int(rec.get("expires_ts", 0) or 0) <= now and now - version <= LICENSE_LAPSE_NOTIFY_WINDOW:
+                    lapsed.append(key)
+        if changed:
+            save_licenses(licenses)
+        return reminders, lapsed
+
+    async def _send_batch(self, reminders, lapsed):
+        messages = [
+            (user_id, f"⏳ Ваша подписка действует до {datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M')}.\n"
+                      "Если автопродление отключено, продлите её командой /pay.")
+            for user_id, ts in reminders
+        ] + [
+            (user_id, "❌ Грейс-период закончился, доступ к боту приостановлен. Оплатить подписку: /pay")
+            for user_id in lapsed
+        ]
+        for user_id, text in messages:
+            try:
+                await bot.send_message(int(user_id), text)
+            except Exception as e:
+                logging.warning(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+            await asyncio.sleep(1 / LICENSE_REMINDER_RATE)
+
+    async def run(self):
+        try:
+            await self._loop()
+        finally:
+            # Следующий инстанс (например, после редеплоя с новым INSTANCE_ID) не ждёт истечения аренды
+            try:
+                state_db.lock_release(self.LOCK_NAME, INSTANCE_ID)
+            except Exception as e:
+                logging.error(f"Не удалось снять блокировку {self.LOCK_NAME}: {e}")
+
+    async def _loop(self):
+        while not shutdown_event.is_set():
+            # Ждём не дольше продления аренды
+            timeout = max(JOB_LOCK_TTL // 3, 1)
+            self.leader = False
+            try:
+                # Рассылкой и чисткой занимается один инстанс
+                self.leader = await job_locks.acquire(self.LOCK_NAME, INSTANCE_ID)
+                if not self.leader:
+                    # Кучу ведёт лидер; свою сбрасываем, иначе просроченная запись
+                    # превращает ожидание в цикл попыток захвата
+                    self.heap = []
+                    self.loaded_mtime = None
+                else:
+                    mtime = self._mtime()
+                    if self.loaded_mtime is None or mtime not in (self.loaded_mtime, self.saved_mtime):
+                        self.rebuild()
+                    now = int(time.time())
+                    due = []
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap))
+                    if due:
+                        reminders, lapsed = self._apply_due(due)
+                        self.loaded_mtime = self._mtime()
+                        logging.info(
+                            f"License scheduler: {len(due)} events, {len(reminders)} reminders, {len(lapsed)} lapsed"
+                        )
+                        await self._send_batch(reminders, lapsed)
+            except Exception as e:
+                logging.error(f"License scheduler error: {e}")
+            # Лидер спит до ближайшего дедлайна
+            if self.leader and self.heap:
+                timeout = min(timeout, max(self.heap[0][0] - time.time(), 0))
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+license_scheduler = LicenseScheduler()
+
 # Безопасно получаем дату окончания периода подписки
 def compute_expires_ts_from_subscription(subscription):
     """Возвращает timestamp окончания текущего периода подписки.
@@ -257,7 +1341,7 @@ def compute_expires_ts_from_subscription(subscription):
 
         if latest_invoice_id:
             try:
-                invoice = stripe.Invoice.retrieve(latest_invoice_id, expand=['lines.data'])
+                invoice = stripe_call("Invoice.retrieve", stripe.Invoice.retrieve, latest_invoice_id, expand=['lines.data'])
                 # Берём первую позицию – это наша подписка
                 lines = None
                 try:
@@ -292,13 +1376,13 @@ def recover_license_from_stripe(user_id: int) -> bool:
         sub = None
         try:
             # 1-я попытка: статус active
-            res = stripe.Subscription.search(query=f"metadata['user_id']:'{user_id}' AND status:'active'", limit=1)
+            res = stripe_call("Subscription.search", stripe.Subscription.search, query=f"metadata['user_id']:'{user_id}' AND status:'active'", limit=1)
             data = getattr(res, 'data', None) if hasattr(res, 'data') else (res.get('data') if isinstance(res, dict) else None)
             if data and len(data) > 0:
                 sub = data[0]
             # 2-я попытка: статус trialing
             if not sub:
-                res = stripe.Subscription.search(query=f"metadata['user_id']:'{user_id}' AND status:'trialing'", limit=1)
+                res = stripe_call("Subscription.search", stripe.Subscription.search, query=f"metadata['user_id']:'{user_id}' AND status:'trialing'", limit=1)
                 data = getattr(res, 'data', None) if hasattr(res, 'data') else (res.get('data') if isinstance(res, dict) else None)
                 if data and len(data) > 0:
                     sub = data[0]
@@ -307,7 +1391,7 @@ def recover_license_from_stripe(user_id: int) -> bool:
         # 2) Фолбэк: перебор последних подписок и фильтр по metadata
         if not sub:
             try:
-                subs = stripe.Subscription.list(limit=50)
+                subs = stripe_call("Subscription.list", stripe.Subscription.list, limit=50)
                 for s in getattr(subs, 'data', subs.get('data', [])):
                     md = getattr(s, 'metadata', None)
                     if not md and isinstance(s, dict):
@@ -333,17 +1417,724 @@ def recover_license_from_stripe(user_id: int) -> bool:
 class DownloadState(StatesGroup):
     waiting_for_link = State()
 
-# Рекурсивная распаковка
-def recursively_unpack(archive_path, extract_dir):
+class JobCancelled(Exception):
+    """Задача отменена пользователем"""
+
+
+class Job:
+    """Задача пользователя: asyncio-задача и запущенные ею дочерние процессы.
+    Каждый процесс стартует в своей сессии, поэтому отмена убивает всю группу.
+    Состояние (стадия, статус каждой ссылки) сохраняется в журнал jobs в StateDB.
+    """
+
+    def __init__(self, user_id: str, chat_id: int, links, job_id=None, link_status=None, stage="download"):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.links = list(links)
+        # pending -> downloaded -> extracted | failed
+        self.link_status = list(link_status or ["pending"] * len(self.links))
+        # download -> validate -> deliver -> done
+        self.stage = stage
+        self.workspace = Path(DOWNLOAD_DIR) / user_id
+        self.lock_name = f"user:{user_id}"
+        self.lock_owner = f"{INSTANCE_ID}/{self.job_id}"
+        self.task = None
+        # Флаг для потоков распаковки (их нельзя прервать через task.cancel())
+        self.cancel_event = threading.Event()
+        # user — отмена пользователем, shutdown — остановка бота (задача продолжится после старта),
+        # lease_lost — аренду перехватил другой процесс
+        self.cancel_reason = None
+        # Группы процессов внешних команд; дублируются в журнале, чтобы супервизор
+        # мог добить их, если воркер упадёт
+        self.pids = set()
+        # Сколько одинаковых по содержимому файлов отброшено
+        self.duplicates = 0
+        # Итоги проверки файлов (см. validate_results)
+        self.validation = None
+        # Сообщение со ссылкой на архив (для кнопки «Удалить архив»)
+        self.link_message_id = None
+
+    @classmethod
+    def from_record(cls, rec):
+        return cls(rec["user_id"], rec["chat_id"], rec["links"], rec["job_id"], rec["link_status"], rec["stage"])
+
+    def record(self, status="running"):
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "chat_id": self.chat_id,
+            "links": self.links,
+            "link_status": self.link_status,
+            "stage": self.stage,
+            "status": status,
+            "workspace": str(self.workspace),
+        }
+
+    async def checkpoint(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        await asyncio.to_thread(state_db.job_update, self.job_id, **fields)
+
+    async def set_link_status(self, index, status):
+        self.link_status[index] = status
+        await self.checkpoint(link_status=self.link_status)
+
+    async def notify(self, text, **kwargs):
+        with span("telegram_send"):
+            return await bot.send_message(self.chat_id, text, **kwargs)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def save_pids(self):
+        state_db.job_update(self.job_id, pids=sorted(self.pids))
+
+    def kill_processes(self):
+        kill_process_groups(self.pids)
+
+    def cancel(self, reason="user"):
+        self.cancel_reason = reason
+        self.cancel_event.set()
+        self.kill_processes()
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+
+def kill_process_groups(pgids):
+    for pgid in list(pgids):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+# Активные задачи этого процесса: user_id -> Job
+active_jobs = {}
+# Выставляется по SIGTERM/SIGINT: новые задачи не принимаются
+shutdown_event = asyncio.Event()
+
+async def run_job_process(job: Job, cmd):
+    """Запускает внешнюю команду как отменяемую часть задачи"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    job.pids.add(proc.pid)
+    try:
+        await asyncio.to_thread(job.save_pids)
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        job.kill_processes()
+        raise
+    finally:
+        job.pids.discard(proc.pid)
+        await asyncio.to_thread(job.save_pids)
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+class UnpackLimitExceeded(Exception):
+    """Архив больше MAX_UNPACK_BYTES"""
+
+
+# Сигнатуры архивов: (смещение, байты, формат)
+_ARCHIVE_MAGIC = (
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"PK\x05\x06", "zip"),  # пустой zip
+    (0, b"PK\x07\x08", "zip"),  # первый том разбитого zip
+    (0, b"Rar!\x1a\x07", "rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"\x1f\x8b", "gz"),
+    (0, b"BZh", "bz2"),
+    (0, b"\xfd7zXZ\x00", "xz"),
+    (257, b"ustar", "tar"),
+)
+
+# Тома многотомных архивов: name.part2.rar, name.r00, name.z01, name.7z.002
+_RAR_PART_RE = re.compile(r"^(.*)\.part0*(\d+)\.rar$", re.I)
+_OLD_VOLUME_RE = re.compile(r"^(.*)\.([rz])\d{2}$", re.I)
+_NUMBERED_VOLUME_RE = re.compile(r"^(.*)\.(\d{3})$")
+
+def is_archive_name(name: str) -> bool:
+    name = name.lower()
+    return name.endswith(ARCHIVE_SUFFIXES) or bool(_OLD_VOLUME_RE.match(name) or _NUMBERED_VOLUME_RE.match(name))
+
+def is_continuation_volume(path: Path) -> bool:
+    """Том, который распаковывается вместе с первым томом набора"""
+    name = path.name
+    m = _RAR_PART_RE.match(name)
+    if m:
+        return int(m.group(2)) > 1
+    if _OLD_VOLUME_RE.match(name):
+        return True
+    m = _NUMBERED_VOLUME_RE.match(name)
+    return bool(m) and int(m.group(2)) > 1
+
+def archive_volumes(path: Path):
+    """Все тома набора, к которому относится первый том path (включая его самого)"""
+    name = path.name
+    m = _RAR_PART_RE.match(name)
+    if m:
+        pattern = re.compile(re.escape(m.group(1)) + r"\.part\d+\.rar$", re.I)
+    elif _NUMBERED_VOLUME_RE.match(name):
+        pattern = re.compile(re.escape(_NUMBERED_VOLUME_RE.match(name).group(1)) + r"\.\d{3}$")
+    elif path.suffix.lower() in (".rar", ".zip"):
+        letter = path.suffix[1].lower()
+        pattern = re.compile(re.escape(path.stem) + r"\." + letter + r"\d{2}$", re.I)
+    else:
+        return [path]
+    try:
+        siblings = [p for p in path.parent.iterdir() if p != path and pattern.match(p.name)]
+    except OSError:
+        siblings = []
+    return [path] + sorted(siblings)
+
+def sniff_archive_format(path) -> str:
+    """Определяет формат архива по заголовку файла. None — не архив"""
     try:
+        with open(path, "rb") as f:
+            head = f.read(512)
+    except OSError:
+        return None
+    for offset, magic, fmt in _ARCHIVE_MAGIC:
+        if head[offset: offset + len(magic)] == magic:
+            return fmt
+    return None
+
+def _check_unpack_size(total: int, path: Path):
+    if MAX_UNPACK_BYTES and total > MAX_UNPACK_BYTES:
+        raise UnpackLimitExceeded(f"{path.name}: {total} байт после распаковки, лимит {MAX_UNPACK_BYTES}")
+
+def _member_target(extract_dir: Path, name: str):
+    """Путь для файла из архива внутри extract_dir (ведущий / отбрасывается); None при выходе через .."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return extract_dir.joinpath(*parts)
+
+def _copy_member(src, target: Path, job: Job = None):
+    """Копирует файл из архива блоками, проверяя отмену: один член бывает размером в гигабайты"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with src, open(target, "wb") as dst:
+        while True:
+            if job:
+                job.check_cancelled()
+            block = src.read(1024 * 1024)
+            if not block:
+                break
+            dst.write(block)
+
+def _extract_zip(path: Path, extract_dir: Path, job: Job = None):
+    with zipfile.ZipFile(path) as zf:
+        members = zf.infolist()
+        _check_unpack_size(sum(info.file_size for info in members), path)
+        for info in members:
+            if job:
+                job.check_cancelled()
+            target = _member_target(extract_dir, info.filename)
+            if target is None:
+                continue
+            if info.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+            else:
+                _copy_member(zf.open(info), target, job)
+
+def _safe_tar_member(member: tarfile.TarInfo) -> bool:
+    parts = Path(member.name).parts
+    return (member.isfile() or member.isdir()) and not member.name.startswith("/") and ".." not in parts
+
+def _extract_tar_or_stream(path: Path, extract_dir: Path, fmt: str, job: Job = None):
+    try:
+        tf = tarfile.open(path, "r:*")
+    except tarfile.ReadError:
+        if fmt == "tar":
+            raise
+        # Одиночный сжатый файл (например, accounts.json.gz)
+        _extract_stream(path, extract_dir, fmt, job)
+        return
+    with tf:
+        # Без getmembers(): он распаковывает весь .tar.gz до первой проверки отмены.
+        # Лимит размера проверяем нарастающим итогом по мере чтения
+        total = 0
+        for member in tf:
+            if job:
+                job.check_cancelled()
+            if not _safe_tar_member(member):
+                continue
+            total += member.size
+            _check_unpack_size(total, path)
+            # Только файлы и папки без абсолютных путей и ..: ссылки и устройства не создаём
+            target = _member_target(extract_dir, member.name)
+            if target is None:
+                continue
+            if member.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+            else:
+                _copy_member(tf.extractfile(member), target, job)
+
+def _extract_stream(path: Path, extract_dir: Path, fmt: str, job: Job = None):
+    opener = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}[fmt]
+    name = path.stem if path.suffix.lower() in (".gz", ".bz2", ".xz") else path.name + ".out"
+    total = 0
+    with opener(path, "rb") as src, open(extract_dir / _safe_name(name), "wb") as dst:
+        while True:
+            if job:
+                job.check_cancelled()
+            block = src.read(1024 * 1024)
+            if not block:
+                break
+            total += len(block)
+            _check_unpack_size(total, path)
+            dst.write(block)
+
+def _extract_with_tool(archive_path: Path, extract_dir: Path, fmt: str, job: Job = None):
+    """Распаковка внешней утилитой (её можно убить вместе с группой процессов)"""
+    tools = []
+    if fmt == "rar" and shutil.which("unar"):
+        tools.append(["unar", "-f", "-D", "-o", str(extract_dir), str(archive_path)])
+    if shutil.which("7z"):
+        tools.append(["7z", "x", "-y", f"-o{extract_dir}", str(archive_path)])
+    if fmt != "rar" and shutil.which("unar"):
+        tools.append(["unar", "-f", "-D", "-o", str(extract_dir), str(archive_path)])
+    if not tools:
         Archive(str(archive_path)).extractall(extract_dir)
-        os.remove(archive_path)
-        for file in os.listdir(extract_dir):
-            file_path = Path(extract_dir) / file
-            if file_path.is_file() and file_path.suffix.lower() in ['.zip', '.rar', '.7z']:
-                recursively_unpack(file_path, extract_dir)
-    except Exception as e:
-        logging.error(f"Ошибка при разархивации: {str(e)}")
+        return
+    errors = []
+    for cmd in tools:
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        if job:
+            job.pids.add(proc.pid)
+        try:
+            if job:
+                job.save_pids()
+            _, stderr = proc.communicate()
+        finally:
+            if job:
+                job.pids.discard(proc.pid)
+                job.save_pids()
+        if job:
+            job.check_cancelled()
+        if proc.returncode == 0:
+            return
+        errors.append(stderr.decode(errors="replace").strip() or f"{cmd[0]} exit code {proc.returncode}")
+    raise RuntimeError("; ".join(errors))
+
+def _extract_archive(archive_path: Path, extract_dir: Path, fmt: str, job: Job = None):
+    """Zip и tar распаковываем в процессе, остальное (и многотомные наборы) — через 7z/unar"""
+    if len(archive_volumes(archive_path)) == 1 and fmt in ("zip", "tar", "gz", "bz2", "xz"):
+        try:
+            if fmt == "zip":
+                _extract_zip(archive_path, extract_dir, job)
+            else:
+                _extract_tar_or_stream(archive_path, extract_dir, fmt, job)
+            return
+        except UnpackLimitExceeded:
+            raise
+        except (zipfile.BadZipFile, tarfile.TarError, NotImplementedError, RuntimeError, EOFError, OSError) as e:
+            # Шифрованный zip, deflate64 и т.п. — пробуем внешней утилитой
+            logging.info(f"In-process {fmt} extraction failed for {archive_path.name}, using external tool: {e}")
+    _extract_with_tool(archive_path, extract_dir, fmt, job)
+
+def iter_archives(directory: Path):
+    """Файлы-архивы в дереве каталога (по сигнатуре; продолжения томов пропускаем)"""
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = Path(root) / name
+            if path.suffix.lower() in TARGET_SUFFIXES or is_continuation_volume(path):
+                continue
+            if sniff_archive_format(path):
+                yield path
+
+# Рекурсивная распаковка (keep_source оставляет исходный архив — из него можно повторить распаковку)
+def recursively_unpack(archive_path, extract_dir, job: Job = None, keep_source=False):
+    queue = [(Path(archive_path), Path(extract_dir), keep_source, 0)]
+    while queue:
+        path, target, keep, depth = queue.pop()
+        if job:
+            job.check_cancelled()
+        fmt = sniff_archive_format(path)
+        if not fmt:
+            continue
+        try:
+            target.mkdir(parents=True, exist_ok=True)
+            size = sum(volume.stat().st_size for volume in archive_volumes(path))
+            with span("archive" if depth == 0 else "nested_extract", format=fmt, depth=depth, bytes=size):
+                _extract_archive(path, target, fmt, job)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка при разархивации {path.name}: {str(e)}")
+            continue
+        if not keep:
+            for volume in archive_volumes(path):
+                volume.unlink(missing_ok=True)
+        # Каждый вложенный архив распаковываем в свою папку — сканируем только новые файлы
+        for nested in list(iter_archives(target)):
+            queue.append((nested, nested.with_name(nested.name + ".unpacked"), False, depth + 1))
+
+# --- Встроенный загрузчик MEGA ---
+
+class MegaError(Exception):
+    """Ошибка API MEGA или повреждённые данные"""
+
+
+_MEGA_FILE_RE = re.compile(r"mega\.nz/(?:file/([\w-]+)#([\w-]+)|#!([\w-]+)!([\w-]+))")
+# Папка, опционально с вложенным узлом: /folder/H#K/folder/N или #F!H!K!N
+_MEGA_FOLDER_RE = re.compile(
+    r"mega\.nz/(?:folder/([\w-]+)#([\w-]+)(?:/(?:file|folder)/([\w-]+))?|#F!([\w-]+)!([\w-]+)(?:[!?]([\w-]+))?)"
+)
+
+async def _gather_or_cancel(tasks):
+    """gather, который при первой ошибке отменяет остальные задачи и дожидается их:
+    они пишут в общие файлы и папки, которые вызывающий сразу закроет или удалит
+    """
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# Общая HTTP-сессия для всех загрузок (пул соединений переиспользуется)
+_http_session = None
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+        )
+    return _http_session
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+def _mega_b64decode(data: str) -> bytes:
+    data = data.replace("-", "+").replace("_", "/").replace(",", "")
+    try:
+        return base64.b64decode(data + "=" * (-len(data) % 4))
+    except binascii.Error as e:
+        raise MegaError(f"Повреждённый ключ или данные в ссылке: {e}")
+
+def _a32(data: bytes):
+    return struct.unpack(f">{len(data) // 4}I", data)
+
+def _a32_bytes(values) -> bytes:
+    return struct.pack(f">{len(values)}I", *values)
+
+def _mega_file_key(key: bytes):
+    """Из 256-битного ключа файла получает AES-ключ, nonce для CTR и ожидаемый MAC"""
+    if len(key) != 32:
+        raise MegaError("Неверный ключ файла в ссылке")
+    k = _a32(key)
+    aes_key = _a32_bytes((k[0] ^ k[4], k[1] ^ k[5], k[2] ^ k[6], k[3] ^ k[7]))
+    return aes_key, _a32_bytes(k[4:6]), (k[6], k[7])
+
+def _mega_decrypt_attrs(attrs_b64: str, aes_key: bytes) -> dict:
+    data = _mega_b64decode(attrs_b64)
+    data = data[: len(data) - len(data) % 16]
+    plain = AES.new(aes_key, AES.MODE_CBC, iv=b"\0" * 16).decrypt(data)
+    if not plain.startswith(b'MEGA{"'):
+        raise MegaError("Неверный ключ: не удалось расшифровать атрибуты")
+    try:
+        return json.loads(plain[4: plain.rindex(b"}") + 1].decode("utf-8", "replace"))
+    except ValueError as e:
+        raise MegaError(f"Не удалось разобрать атрибуты файла: {e}")
+
+def _mega_chunks(size: int):
+    """Границы чанков MEGA для подсчёта MAC: 128К, 256К, … 1М, дальше по 1М"""
+    chunks = []
+    start, step = 0, 0x20000
+    while start < size:
+        end = min(start + step, size)
+        chunks.append((start, end))
+        start = end
+        if step < 0x100000:
+            step += 0x20000
+    return chunks
+
+def _mega_segments(chunks, done):
+    """Группирует недокачанные чанки в непрерывные диапазоны ~MEGA_SEGMENT_BYTES"""
+    segments, current = [], []
+    for chunk in chunks:
+        if chunk[0] in done:
+            if current:
+                segments.append(current)
+                current = []
+            continue
+        current.append(chunk)
+        if current[-1][1] - current[0][0] >= MEGA_SEGMENT_BYTES:
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    return segments
+
+def _mega_decrypt_chunk(cipher, aes_key, iv8, data, fd, offset):
+    """Расшифровывает чанк, пишет его на место в файле и возвращает CBC-MAC чанка"""
+    plain = cipher.decrypt(data)
+    os.pwrite(fd, plain, offset)
+    if len(plain) % 16:
+        plain += b"\0" * (16 - len(plain) % 16)
+    return AES.new(aes_key, AES.MODE_CBC, iv=iv8 + iv8).encrypt(plain)[-16:]
+
+def _mega_file_mac(aes_key, chunk_macs):
+    mac = _a32(AES.new(aes_key, AES.MODE_CBC, iv=b"\0" * 16).encrypt(b"".join(chunk_macs))[-16:])
+    return (mac[0] ^ mac[1], mac[2] ^ mac[3])
+
+
+class MegaClient:
+    """Минимальный клиент API MEGA для публичных ссылок"""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+        self.seq = random.randint(0, 0xFFFFFFFF)
+
+    async def api(self, payload: dict, params: dict = None):
+        for attempt in range(MEGA_RETRIES):
+            self.seq += 1
+            query = {"id": str(self.seq), **(params or {})}
+            try:
+                async with self.session.post(MEGA_API_URL, params=query, json=[payload]) as resp:
+                    status, body = resp.status, await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                code = str(e)
+            else:
+                try:
+                    data = json.loads(body) if status == 200 else None
+                except ValueError:
+                    data = None
+                if isinstance(data, list):
+                    data = data[0] if data else None
+                if isinstance(data, int):
+                    code = data
+                    # -3 (EAGAIN) — сервер просит повторить позже, остальные коды окончательные
+                    if code != -3:
+                        raise MegaError(f"MEGA API error {code}")
+                elif isinstance(data, dict):
+                    return data
+                else:
+                    # 5xx, страница ошибки прокси или пустой ответ — сбой на стороне MEGA, повторяем
+                    code = f"HTTP {status}: {body[:100]!r}"
+            if attempt + 1 < MEGA_RETRIES:
+                logging.warning(f"MEGA API request failed ({code}), retrying")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        raise MegaError(f"MEGA API недоступен: {code}")
+
+    async def fetch(self, url: str, size: int, aes_key: bytes, iv8: bytes, meta_mac, dest: Path, job=None):
+        """Качает файл параллельными диапазонами, расшифровывая AES-CTR на лету.
+        Прогресс хранится рядом в .part.json — после сбоя докачиваются только недостающие чанки.
+        """
+        part = dest.with_name(dest.name + ".part")
+        state_path = dest.with_name(dest.name + ".part.json")
+        key_id = hashlib.sha256(aes_key + iv8).hexdigest()[:16]
+        done = {}
+        if part.exists() and state_path.exists():
+            try:
+                saved = json.loads(state_path.read_text())
+                if saved.get("size") == size and saved.get("key") == key_id:
+                    done = {int(k): bytes.fromhex(v) for k, v in saved["done"].items()}
+            except Exception as e:
+                logging.warning(f"Не удалось прочитать состояние докачки {state_path}: {e}")
+        if done:
+            logging.info(f"Resuming {dest.name}: {len(done)} chunks already downloaded")
+
+        def save_state(payload: str):
+            tmp = state_path.with_suffix(".tmp")
+            tmp.write_text(payload)
+            os.replace(tmp, state_path)
+
+        def state_payload() -> str:
+            # Снимок done делаем в цикле событий: диапазоны дописывают его параллельно
+            return json.dumps({"size": size, "key": key_id, "done": {str(k): v.hex() for k, v in done.items()}})
+
+        chunks = _mega_chunks(size)
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            semaphore = asyncio.Semaphore(MEGA_PARALLEL_RANGES)
+            last_save = [time.monotonic()]
+
+            async def fetch_segment(segment):
+                async with semaphore:
+                    for attempt in range(MEGA_RETRIES):
+                        # Чанки внутри диапазона идут по порядку: при повторе берём оставшийся хвост
+                        pending = [c for c in segment if c[0] not in done]
+                        if not pending:
+                            return
+                        try:
+                            await self._fetch_range(url, pending, aes_key, iv8, fd, done, job)
+                            return
+                        except (aiohttp.ClientError, asyncio.TimeoutError, MegaError) as e:
+                            if attempt + 1 == MEGA_RETRIES:
+                                raise MegaError(f"Не удалось скачать диапазон: {e}")
+                            logging.warning(f"Retrying range of {dest.name}: {e}")
+                            await asyncio.sleep(min(2 ** attempt, 30))
+                        finally:
+                            if time.monotonic() - last_save[0] > 2:
+                                last_save[0] = time.monotonic()
+                                await asyncio.to_thread(save_state, state_payload())
+
+            # Все диапазоны пишут в один fd: до его закрытия они должны завершиться,
+            # иначе pwrite попадёт в чужой файл, получивший тот же номер дескриптора
+            await _gather_or_cancel([asyncio.create_task(fetch_segment(seg)) for seg in _mega_segments(chunks, done)])
+        finally:
+            os.close(fd)
+            if part.exists():
+                await asyncio.to_thread(save_state, state_payload())
+
+        if size and _mega_file_mac(aes_key, [done[start] for start, _ in chunks]) != tuple(meta_mac):
+            part.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            raise MegaError(f"Контрольная сумма {dest.name} не совпала")
+        os.replace(part, dest)
+        state_path.unlink(missing_ok=True)
+        return dest
+
+    async def _fetch_range(self, url, pending, aes_key, iv8, fd, done, job=None):
+        start, end = pending[0][0], pending[-1][1]
+        cipher = AES.new(aes_key, AES.MODE_CTR, nonce=iv8, initial_value=start // 16)
+        buf = bytearray()
+        index = 0
+        async with self.session.get(f"{url}/{start}-{end - 1}") as resp:
+            if resp.status != 200:
+                raise MegaError(f"HTTP {resp.status}")
+            async for piece in resp.content.iter_chunked(256 * 1024):
+                if job:
+                    job.check_cancelled()
+                buf += piece
+                while index < len(pending) and len(buf) >= pending[index][1] - pending[index][0]:
+                    chunk_start, chunk_end = pending[index]
+                    data = bytes(buf[: chunk_end - chunk_start])
+                    del buf[: chunk_end - chunk_start]
+                    done[chunk_start] = await _run_to_completion(
+                        _mega_decrypt_chunk, cipher, aes_key, iv8, data, fd, chunk_start
+                    )
+                    index += 1
+        if index < len(pending):
+            raise MegaError("Соединение оборвалось до конца диапазона")
+
+
+def _safe_name(name: str) -> str:
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        return "file.bin"
+    return name
+
+def native_download_supported(link: str) -> bool:
+    if AES is None or MEGA_DOWNLOADER not in ("auto", "native"):
+        return False
+    return bool(_MEGA_FOLDER_RE.search(link) or _MEGA_FILE_RE.search(link))
+
+async def mega_download_file(link: str, dest_dir: Path, job=None) -> Path:
+    """Скачивает публичную ссылку на файл встроенным загрузчиком"""
+    match = _MEGA_FILE_RE.search(link)
+    if not match:
+        raise MegaError("Неподдерживаемая ссылка MEGA")
+    handle = match.group(1) or match.group(3)
+    aes_key, iv8, meta_mac = _mega_file_key(_mega_b64decode(match.group(2) or match.group(4)))
+    client = MegaClient(await get_http_session())
+    info = await client.api({"a": "g", "g": 1, "p": handle})
+    attrs = _mega_decrypt_attrs(info["at"], aes_key)
+    dest = dest_dir / _safe_name(attrs.get("n"))
+    return await client.fetch(info["g"], int(info["s"]), aes_key, iv8, meta_mac, dest, job)
+
+def _mega_decrypt_node(node: dict, folder_key: bytes):
+    """Расшифровывает ключ и атрибуты узла папки. Возвращает (key, attrs) или None"""
+    # Поле k: "владелец:ключ" — их может быть несколько через "/"
+    for part in (node.get("k") or "").split("/"):
+        if ":" not in part:
+            continue
+        try:
+            enc = _mega_b64decode(part.split(":", 1)[1])
+            key = AES.new(folder_key, AES.MODE_ECB).decrypt(enc[: len(enc) - len(enc) % 16])
+            attr_key = _mega_file_key(key)[0] if node.get("t") == 0 else key
+            return key, _mega_decrypt_attrs(node["a"], attr_key)
+        except (MegaError, ValueError, KeyError):
+            continue
+    return None
+
+def _is_wanted_node(name: str, size: int) -> bool:
+    if not (is_archive_name(name) or name.lower().endswith(TARGET_SUFFIXES)):
+        return False
+    return not MEGA_FOLDER_MAX_FILE_BYTES or size <= MEGA_FOLDER_MAX_FILE_BYTES
+
+async def mega_download_folder(link: str, dest_dir: Path, job=None):
+    """Скачивает из папки MEGA только архивы и .json/.session файлы.
+    Сначала получает дерево узлов, затем параллельно качает отобранные файлы.
+    """
+    match = _MEGA_FOLDER_RE.search(link)
+    if not match:
+        raise MegaError("Неподдерживаемая ссылка MEGA")
+    folder_handle = match.group(1) or match.group(4)
+    folder_key = _mega_b64decode(match.group(2) or match.group(5))
+    sub_node = match.group(3) or match.group(6)
+    if len(folder_key) != 16:
+        raise MegaError("Неверный ключ папки в ссылке")
+
+    client = MegaClient(await get_http_session())
+    listing = await client.api({"a": "f", "c": 1, "r": 1, "ca": 1}, params={"n": folder_handle})
+    nodes = {}
+    for node in listing.get("f", []):
+        decrypted = _mega_decrypt_node(node, folder_key)
+        if decrypted:
+            nodes[node["h"]] = (node, *decrypted)
+
+    def node_path(handle):
+        parts = []
+        while handle in nodes:
+            node, _, attrs = nodes[handle]
+            parts.append(_safe_name(attrs.get("n")))
+            if handle == sub_node:
+                return parts[::-1]
+            handle = node.get("p")
+        # Без вложенного узла путь строится от корня папки (сам корень не включаем)
+        return None if sub_node else parts[::-1][1:]
+
+    selected, total_bytes = [], 0
+    for handle, (node, key, attrs) in nodes.items():
+        if node.get("t") != 0:
+            continue
+        size = int(node.get("s", 0))
+        total_bytes += size
+        path = node_path(handle)
+        if path is None or not _is_wanted_node(attrs.get("n") or "", size):
+            continue
+        selected.append((handle, key, size, dest_dir.joinpath(*path) if path else dest_dir / _safe_name(attrs.get("n"))))
+    selected_bytes = sum(size for _, _, size, _ in selected)
+    logging.info(
+        f"MEGA folder {folder_handle}: selected {len(selected)} of {len(nodes)} nodes, "
+        f"{selected_bytes} of {total_bytes} bytes"
+    )
+
+    semaphore = asyncio.Semaphore(MEGA_FOLDER_PARALLEL)
+
+    async def fetch_node(handle, key, size, dest):
+        async with semaphore:
+            # Файл уже скачан до перезапуска
+            if dest.exists() and dest.stat().st_size == size:
+                return
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            aes_key, iv8, meta_mac = _mega_file_key(key)
+            info = await client.api({"a": "g", "g": 1, "n": handle}, params={"n": folder_handle})
+            await client.fetch(info["g"], size, aes_key, iv8, meta_mac, dest, job)
+
+    # При ошибке остальные файлы останавливаем до возврата: иначе они продолжат писать
+    # в папку, которую запасной путь через megatools очищает и заполняет заново
+    await _gather_or_cancel([asyncio.create_task(fetch_node(*item)) for item in selected])
+    return [dest for _, _, _, dest in selected]
+
 
 # /start
 @dp.message(Command(commands=['start']))
@@ -382,8 +2173,21 @@ async def start_in_waiting_state(message: types.Message, state: FSMContext):
 @dp.message(StateFilter(DownloadState.waiting_for_link), Command(commands=['cancel']))
 async def cancel_in_waiting_state(message: types.Message, state: FSMContext):
     await state.clear()
+    if await cancel_user_job(str(message.from_user.id)):
+        await message.reply("Текущая задача остановлена. Режим ожидания ссылок сброшен.")
+        return
     await message.reply("Режим ожидания ссылок сброшен. Отправьте /start или пришлите ссылку на MEGA.")
 
+async def cancel_user_job(user_id: str) -> bool:
+    """Отменяет задачу пользователя: убивает процессы, прерывает распаковку"""
+    job = active_jobs.get(user_id)
+    if job and not job.cancelled:
+        job.cancel()
+        logging.info(f"Job {job.job_id} of user {user_id} cancelled")
+        return True
+    # Задача в воркере или на другом инстансе: она увидит флаг в журнале
+    return await asyncio.to_thread(state_db.job_request_cancel, user_id)
+
 # обработка ссылок
 @dp.message(StateFilter(DownloadState.waiting_for_link))
 async def process_link(message: types.Message, state: FSMContext):
@@ -412,118 +2216,563 @@ async def process_link(message: types.Message, state: FSMContext):
         await message.reply("Не найдено ни одной ссылки на MEGA.")
         return
 
+    if shutdown_event.is_set():
+        await message.reply("Бот перезапускается, отправьте ссылки через минуту.")
+        return
+
     user_id = str(message.from_user.id)
-    user_output_dir = Path(OUTPUT_DIR) / user_id
+    job = Job(user_id, message.chat.id, links)
+    if WORKER_PROCESSES:
+        await enqueue_job(message, job)
+        return
+    # Одна задача на пользователя — в том числе между инстансами бота
+    if not await job_locks.acquire(job.lock_name, job.lock_owner):
+        await message.reply("У вас уже выполняется задача. Дождитесь её завершения или отправьте /cancel.")
+        return
+
+    # Регистрируем задачу сразу, чтобы цикл возобновления не принял её за прерванную
+    active_jobs[user_id] = job
+    try:
+        # Удаляем старые файлы перед началом новой загрузки
+        await fs.reset_dir(Path(OUTPUT_DIR) / user_id)
+        await fs.reset_dir(job.workspace)
+        await asyncio.to_thread(state_db.job_save, job.record())
+    except Exception as e:
+        active_jobs.pop(user_id, None)
+        await job_locks.release(job.lock_name, job.lock_owner)
+        logging.error(f"Не удалось создать задачу: {e}")
+        await message.reply(f"Ошибка: {str(e)}")
+        return
+    start_job(job, f"⏳ Обрабатываю ссылок: {len(links)}")
+
+
+def start_job(job: Job, progress_text: str):
+    active_jobs[job.user_id] = job
+    job.task = asyncio.create_task(run_job(job, progress_text))
+
+async def _job_heartbeat(job: Job):
+    while True:
+        await asyncio.sleep(max(JOB_LOCK_TTL // 3, 1))
+        try:
+            held = await job_locks.refresh(job.lock_name, job.lock_owner)
+        except Exception as e:
+            # Аренда ещё может быть жива — попробуем продлить в следующий раз
+            logging.warning(f"Не удалось продлить аренду задачи {job.job_id}: {e}")
+            continue
+        if not held:
+            # Аренда истекла и её перехватил другой процесс: он продолжит задачу в той же папке
+            logging.error(f"Job {job.job_id} lost its lease; stopping")
+            job.cancel("lease_lost")
+            return
+
+async def _job_cancel_watch(job: Job):
+    """Передаёт задаче отмену, выставленную в журнале другим процессом"""
+    while not job.cancelled:
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+        try:
+            if await asyncio.to_thread(state_db.job_cancel_requested, job.job_id):
+                job.cancel()
+                logging.info(f"Job {job.job_id} of user {job.user_id} cancelled")
+        except sqlite3.Error as e:
+            logging.warning(f"Не удалось проверить отмену задачи {job.job_id}: {e}")
+
+async def run_job(job: Job, progress_text: str):
+    """Выполняет задачу и фиксирует итоговый статус в журнале"""
+    stop_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить", callback_data="cancel_job")]
+    ])
+    progress_message = None
+    heartbeat = asyncio.create_task(_job_heartbeat(job))
+    cancel_watch = asyncio.create_task(_job_cancel_watch(job))
+    status = "done"
+    status_text = "✅ Обработка завершена"
+    try:
+        # trace_id = job_id: после рестарта задача продолжает ту же трассу
+        with span("job", trace_id=job.job_id, user_id=job.user_id, links=len(job.links), stage=job.stage):
+            progress_message = await job.notify(progress_text, reply_markup=stop_keyboard)
+            await process_job(job)
+    except (asyncio.CancelledError, JobCancelled):
+        if job.cancel_reason == "shutdown":
+            # Запись остаётся в статусе running — задача продолжится после старта
+            status = "running"
+            status_text = "⏸ Бот перезапускается — обработка продолжится автоматически"
+        elif job.cancel_reason == "lease_lost":
+            # Журнал и папки задачи теперь у нового владельца аренды — ничего не трогаем
+            status = None
+            status_text = "⏸ Обработку продолжит другой процесс бота"
+        else:
+            # Сразу освобождаем место на диске
+            await fs.rmtree(job.workspace)
+            await fs.rmtree(Path(OUTPUT_DIR) / job.user_id)
+            status = "cancelled"
+            status_text = "⛔ Задача остановлена, временные файлы удалены"
+    except Exception as e:
+        logging.error(f"Job {job.job_id} failed: {e}")
+        status = "failed"
+        status_text = f"Ошибка: {str(e)}"
+    finally:
+        heartbeat.cancel()
+        cancel_watch.cancel()
+        active_jobs.pop(job.user_id, None)
+        fields = {"status": status}
+        if status in ("done", "failed", "cancelled"):
+            # В ссылках MEGA ключ расшифровки — в завершённых записях их не храним
+            fields["links"] = []
+        summary = job_traces.summary(job.job_id)
+        if summary:
+            fields["trace"] = json.dumps(summary, ensure_ascii=False, default=str)
+        try:
+            if status:
+                await asyncio.to_thread(state_db.job_update, job.job_id, **fields)
+        except Exception as e:
+            logging.error(f"Не удалось обновить журнал задачи {job.job_id}: {e}")
+        await job_locks.release(job.lock_name, job.lock_owner)
+    if progress_message:
+        try:
+            with span("telegram_edit", trace_id=job.job_id):
+                await progress_message.edit_text(status_text)
+        except Exception as e:
+            logging.warning(f"Не удалось обновить сообщение: {e}")
+
+async def process_job(job: Job):
+    """Стадии задачи. Каждая завершённая ссылка/стадия сохраняется в журнал,
+    поэтому после рестарта задача продолжает с того же места.
+    """
+    user_output_dir = Path(OUTPUT_DIR) / job.user_id
     user_output_dir.mkdir(parents=True, exist_ok=True)
-    # Удаляем старые файлы перед началом новой загрузки
-    import shutil
-    for old_file in user_output_dir.glob("*"):
-        if old_file.is_file():
-            old_file.unlink()
-        elif old_file.is_dir():
-            shutil.rmtree(old_file, ignore_errors=True)
-    import time
-    start_time = time.time()
-
-    for file in os.listdir(DOWNLOAD_DIR):
-        file_path = Path(DOWNLOAD_DIR) / file
-        if file_path.is_file():
-            os.remove(file_path)
-
-    for link in links:
+    job.workspace.mkdir(parents=True, exist_ok=True)
+
+    if job.stage == "download":
+        # Учитывает и файлы, собранные до рестарта
+        deduper = await fs.run(ResultDeduper, user_output_dir)
+        for index, link in enumerate(job.links):
+            job.check_cancelled()
+            if job.link_status[index] in ("extracted", "failed"):
+                continue
+            link_dir = job.workspace / f"link_{index}"
+            # Ссылку целиком не пишем: в ней ключ расшифровки
+            with span("link", index=index, folder=bool(_MEGA_FOLDER_RE.search(link))) as link_span:
+                try:
+                    if job.link_status[index] == "pending":
+                        link_dir.mkdir(parents=True, exist_ok=True)
+                        with span("download") as download_span:
+                            if not await download_link(job, link, link_dir):
+                                await job.set_link_status(index, "failed")
+                                link_span.set(result="failed")
+                                continue
+                            downloaded = await fs.scan_files(link_dir, recursive=True)
+                            download_span.set(files=len(downloaded), bytes=sum(size for _, size in downloaded))
+                        await job.set_link_status(index, "downloaded")
+                    # При отмене ждём поток распаковки: run_job удаляет папки и снимает
+                    # блокировку, а поток иначе продолжил бы писать в них
+                    await _run_to_completion(collect_link_results, link_dir, deduper, job)
+                    job.duplicates = deduper.duplicates
+                    await job.set_link_status(index, "extracted")
+                    await fs.rmtree(link_dir)
+                    link_span.set(result="extracted")
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    link_span.set(result="failed", error=str(e)[:200])
+                    await job.notify(f"Ошибка: {str(e)}")
+                    await job.set_link_status(index, "failed")
+        await job.checkpoint(stage="validate")
+
+    job.check_cancelled()
+    if job.stage == "validate":
+        with span("validate"):
+            await validate_results(job, user_output_dir)
+        await job.checkpoint(stage="deliver")
+
+    job.check_cancelled()
+    if job.stage == "deliver":
+        with span("deliver"):
+            await deliver_results(job, user_output_dir)
+        await job.checkpoint(stage="done")
+
+async def download_link(job: Job, link: str, link_dir: Path) -> bool:
+    if native_download_supported(link):
         try:
-            # Пробуем megatools, если недоступен - megadl
-            if shutil.which("megatools"):
-                cmd = ["megatools", "dl", "--path", str(DOWNLOAD_DIR), link]
-            elif shutil.which("megadl"):
-                cmd = ["megadl", "--path", str(DOWNLOAD_DIR), link]
+            # Встроенный загрузчик докачивает .part-файлы, оставшиеся после сбоя
+            if _MEGA_FOLDER_RE.search(link):
+                if not await mega_download_folder(link, link_dir, job):
+                    await job.notify("В папке нет архивов и файлов .json/.session.")
+                    return False
             else:
-                await message.reply("Ошибка: не найдены ни megatools, ни megadl")
-                continue
-                
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                await message.reply(f"Ошибка при скачивании: {result.stderr}")
-                continue
+                await mega_download_file(link, link_dir, job)
+            trace_set(method="native")
+            return True
+        except (MegaError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, struct.error) as e:
+            if MEGA_DOWNLOADER == "native":
+                await job.notify(f"Ошибка при скачивании: {e}")
+                return False
+            logging.warning(f"Native MEGA download failed, falling back to megatools: {e}")
+
+    # Недокачанные файлы megatools продолжить не умеет — качаем ссылку заново
+    await fs.reset_dir(link_dir)
+    # Пробуем megatools, если недоступен - megadl
+    if shutil.which("megatools"):
+        cmd = ["megatools", "dl", "--path", str(link_dir), link]
+    elif shutil.which("megadl"):
+        cmd = ["megadl", "--path", str(link_dir), link]
+    else:
+        await job.notify("Ошибка: не найдены ни megatools, ни megadl")
+        return False
 
-            downloaded_files = sorted(
-                [f for f in os.listdir(DOWNLOAD_DIR) if (Path(DOWNLOAD_DIR) / f).is_file()],
-                key=lambda f: os.path.getmtime(Path(DOWNLOAD_DIR) / f),
-                reverse=True
-            )
-            if not downloaded_files:
-                await message.reply("Файл не был скачан.")
-                continue
+    trace_set(method=cmd[0])
+    returncode, _, stderr = await run_job_process(job, cmd)
+    job.check_cancelled()
+    if returncode != 0:
+        await job.notify(f"Ошибка при скачивании: {stderr}")
+        return False
+    if not await fs.scan_files(link_dir, recursive=True):
+        await job.notify("Файл не был скачан.")
+        return False
+    return True
+
+def _file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
 
-            file_path = Path(DOWNLOAD_DIR) / downloaded_files[0]
-            if file_path.suffix.lower() in ['.zip', '.rar', '.7z']:
-                extract_dir = os.path.join(user_output_dir, file_path.stem)
-                os.makedirs(extract_dir, exist_ok=True)
-                recursively_unpack(file_path, extract_dir)
-            else:
-                new_path = user_output_dir / file_path.name
-                os.rename(file_path, new_path)
-
-            if 'extract_dir' in locals() and os.path.exists(extract_dir):
-                for root, dirs, files in os.walk(extract_dir, topdown=False):
-                    for name in files:
-                        fpath = Path(root) / name
-                        if fpath.suffix.lower() in ['.json', '.session']:
-                            os.rename(fpath, user_output_dir / fpath.name)
-                        else:
-                            os.remove(fpath)
-                    for d in dirs:
-                        try:
-                            os.rmdir(Path(root) / d)
-                        except OSError:
-                            pass
-                try:
-                    os.rmdir(extract_dir)
-                except OSError:
-                    pass
 
-        except Exception as e:
-            await message.reply(f"Ошибка: {str(e)}")
-
-    final_files = [f for f in user_output_dir.iterdir() if f.is_file() and f.suffix.lower() in ['.json', '.session']]
-    # Отфильтровываем только файлы, добавленные после начала обработки
-    recent_files = []
-    for f in final_files:
-        if f.stat().st_mtime >= start_time:
-            recent_files.append(f)
-    final_files = recent_files
-
-    if not final_files:
-        await message.reply("Готово! Но не найдено файлов .json или .session.")
+class ResultDeduper:
+    """Собирает .json/.session в папку пользователя, оставляя одну копию на содержимое.
+    Файлы с одинаковым именем, но разным содержимым получают суффикс _2, _3, …
+    Пара acc.session + acc.json из одной папки переносится как единое целое (add_group):
+    оба файла получают общий суффикс, иначе validate_results не сведёт их в пару.
+    """
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self.digests = {}
+        self.names = set()
+        self.duplicates = 0
+        for path, _ in _scan_files(output_dir, TARGET_SUFFIXES):
+            if path.name != MANIFEST_NAME:
+                self.digests.setdefault(_file_digest(path), path.name)
+                self.names.add(path.name)
+
+    def _place(self, src: Path, digest: str, stem: str):
+        name = f"{stem}{src.suffix}"
+        os.replace(src, self.output_dir / name)
+        self.digests.setdefault(digest, name)
+        self.names.add(name)
+
+    def _drop(self, src: Path):
+        src.unlink(missing_ok=True)
+        self.duplicates += 1
+
+    def add_group(self, srcs):
+        """Переносит файлы одного аккаунта (одна папка, одна основа имени).
+        Возвращает перенесённые исходные пути.
+        """
+        digests = [_file_digest(src) for src in srcs]
+        known = [digest in self.digests for digest in digests]
+        if all(known):
+            for src in srcs:
+                self._drop(src)
+            return []
+        fresh = [(src, digest) for src, digest, dup in zip(srcs, digests, known) if not dup]
+        if any(known):
+            # Дубликат уже лежит в результате: новые файлы пары встают рядом с его копией
+            stems = {Path(self.digests[digest]).stem for digest, dup in zip(digests, known) if dup}
+            if len(stems) == 1:
+                stem = stems.pop()
+                if all(f"{stem}{src.suffix}" not in self.names for src, _ in fresh):
+                    for src, dup in zip(srcs, known):
+                        if dup:
+                            self._drop(src)
+                    for src, digest in fresh:
+                        self._place(src, digest, stem)
+                    return [src for src, _ in fresh]
+        # Иначе пара переносится целиком под общей свободной основой имени
+        base = srcs[0].stem
+        stem, n = base, 2
+        while any(f"{stem}{src.suffix}" in self.names for src in srcs):
+            stem = f"{base}_{n}"
+            n += 1
+        for src, digest in zip(srcs, digests):
+            self._place(src, digest, stem)
+        return list(srcs)
+
+
+def _result_groups(paths):
+    """Группирует файлы результата по аккаунтам: одна папка и одна основа имени"""
+    groups = {}
+    for path in paths:
+        groups.setdefault((path.parent, path.stem), []).append(path)
+    return list(groups.values())
+
+
+def collect_link_results(link_dir: Path, deduper: ResultDeduper, job: Job):
+    """Распаковывает скачанное по ссылке и переносит .json/.session в папку пользователя"""
+    extract_root = link_dir / "_extract"
+    # Повторная распаковка после рестарта начинается с чистого листа
+    shutil.rmtree(extract_root, ignore_errors=True)
+    downloaded = [
+        Path(root) / name
+        for root, dirs, files in os.walk(link_dir)
+        for name in files
+    ]
+    results = []
+    for file_path in downloaded:
+        job.check_cancelled()
+        if file_path.suffix.lower() in TARGET_SUFFIXES:
+            results.append(file_path)
+        elif not is_continuation_volume(file_path) and sniff_archive_format(file_path):
+            # Не-архивы отсеиваются по заголовку, без запуска внешних утилит
+            recursively_unpack(file_path, extract_root / file_path.name, job, keep_source=True)
+    for group in _result_groups(results):
+        deduper.add_group(group)
+
+    if extract_root.exists():
+        with span("filter") as filter_span:
+            found = [
+                Path(root) / name
+                for root, dirs, files in os.walk(extract_root)
+                for name in files
+                if Path(name).suffix.lower() in TARGET_SUFFIXES
+            ]
+            sizes = {path: path.stat().st_size for path in found}
+            kept = [path for group in _result_groups(found) for path in deduper.add_group(group)]
+            filter_span.set(files=len(found), kept=len(kept), bytes=sum(sizes[path] for path in kept))
+            shutil.rmtree(extract_root, ignore_errors=True)
+
+_validation_pool = ThreadPoolExecutor(max_workers=VALIDATION_WORKERS, thread_name_prefix="validate")
+
+def validate_result_file(path: Path):
+    """Проверяет файл результата. Возвращает (ok, error)"""
+    try:
+        if path.suffix.lower() == ".session":
+            with open(path, "rb") as f:
+                if f.read(16) != b"SQLite format 3\x00":
+                    return False, "не SQLite-файл"
+            uri = path.absolute().as_uri() + "?mode=ro&immutable=1"
+            conn = sqlite3.connect(uri, uri=True)
+            try:
+                if conn.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                    return False, "повреждённая база"
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                # Telethon и Pyrogram хранят ключ авторизации в таблице sessions
+                if "sessions" not in tables:
+                    return False, "нет таблицы sessions"
+                if not conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+                    return False, "пустая сессия"
+            finally:
+                conn.close()
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                if not isinstance(json.load(f), dict):
+                    return False, "JSON не является объектом"
+        return True, None
+    except (sqlite3.Error, ValueError, UnicodeDecodeError, OSError) as e:
+        return False, str(e)
+
+async def validate_results(job: Job, user_output_dir: Path):
+    """Проверяет файлы на пуле потоков, убирает битые в invalid/ и пишет манифест с парами"""
+    files = sorted(
+        f for f, _ in await fs.scan_files(user_output_dir, TARGET_SUFFIXES) if f.name != MANIFEST_NAME
+    )
+    loop = asyncio.get_running_loop()
+    checks = await asyncio.gather(*(
+        loop.run_in_executor(_validation_pool, contextvars.copy_context().run, validate_result_file, f)
+        for f in files
+    ))
+
+    invalid_dir = user_output_dir / "invalid"
+    invalid, moves, sessions, jsons = [], [], {}, {}
+    for path, (ok, error) in zip(files, checks):
+        if not ok:
+            invalid.append({"file": path.name, "error": error})
+            moves.append((path, invalid_dir / path.name))
+        elif path.suffix.lower() == ".session":
+            sessions[path.stem] = path.name
+        else:
+            jsons[path.stem] = path.name
+
+    accounts = []
+    for stem in sorted(set(sessions) | set(jsons)):
+        session, meta = sessions.get(stem), jsons.get(stem)
+        status = "paired" if session and meta else ("session_only" if session else "json_only")
+        accounts.append({"account": stem, "session": session, "json": meta, "status": status})
+    manifest = {
+        "accounts": accounts,
+        "invalid": invalid,
+        "summary": {
+            "accounts": len(accounts),
+            "paired": sum(1 for a in accounts if a["status"] == "paired"),
+            "invalid": len(invalid),
+        },
+    }
+    await fs.move_files(moves)
+    await fs.run(
+        (user_output_dir / MANIFEST_NAME).write_text,
+        json.dumps(manifest, ensure_ascii=False, indent=2),
+        encoding="utf-8",
+    )
+    job.validation = manifest["summary"]
+    trace_set(files=len(files), **job.validation)
+    logging.info(f"Job {job.job_id} validation: {job.validation}")
+
+def _load_validation_summary(user_output_dir: Path):
+    try:
+        return json.loads((user_output_dir / MANIFEST_NAME).read_text(encoding="utf-8"))["summary"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+# Форматы, которые уже сжаты: повторное deflate тратит CPU впустую
+_COMPRESSED_SUFFIXES = (
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.heic', '.mp4', '.mkv', '.mov', '.webm', '.mp3', '.ogg', '.m4a',
+)
+
+def _sample_entropy(path: Path, size: int, sample_bytes: int = 16 * 1024) -> float:
+    """Энтропия Шеннона (бит на байт) по выборкам из начала, середины и конца файла"""
+    with open(path, "rb") as f:
+        sample = f.read(sample_bytes)
+        for offset in (size // 2, size - sample_bytes):
+            if offset > sample_bytes:
+                f.seek(offset)
+                sample += f.read(sample_bytes)
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(n / total * math.log2(n / total) for n in Counter(sample).values())
+
+def choose_compression(path: Path, size: int):
+    """Политика сжатия файла: (имя, compress_type, compresslevel)"""
+    if path.suffix.lower() in _COMPRESSED_SUFFIXES:
+        return "stored", zipfile.ZIP_STORED, None
+    entropy = _sample_entropy(path, size)
+    if entropy > 7.5:
+        return "stored", zipfile.ZIP_STORED, None
+    # .session (страницы SQLite) и JSON жмутся хорошо — при balanced на них тратим больше CPU
+    if ARCHIVE_CPU_BUDGET == "max" or (ARCHIVE_CPU_BUDGET == "balanced" and entropy < 6.0):
+        return "high", zipfile.ZIP_DEFLATED, 9
+    return "fast", zipfile.ZIP_DEFLATED, 1
+
+def build_zip(files, dest) -> dict:
+    """Собирает zip с пофайловой политикой сжатия и возвращает статистику сборки"""
+    started = time.monotonic()
+    policy = Counter()
+    raw_bytes = 0
+    with zipfile.ZipFile(dest, "w") as zf:
+        for f in files:
+            size = f.stat().st_size
+            raw_bytes += size
+            name, compress_type, level = choose_compression(f, size)
+            policy[name] += 1
+            zf.write(f, f.name, compress_type=compress_type, compresslevel=level)
+    zip_bytes = dest.getbuffer().nbytes if isinstance(dest, io.BytesIO) else os.path.getsize(dest)
+    return {
+        "budget": ARCHIVE_CPU_BUDGET,
+        "files": sum(policy.values()),
+        "policy": dict(policy),
+        "raw_bytes": raw_bytes,
+        "zip_bytes": zip_bytes,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+def build_zip_bytes(files):
+    buf = io.BytesIO()
+    stats = build_zip(files, buf)
+    return buf.getvalue(), stats
+
+def build_share_zip(folder: Path, zip_path: Path) -> dict:
+    # Пишем во временный файл: параллельный запрос не получит недописанный архив
+    tmp_path = zip_path.with_name(f"{zip_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        stats = build_zip(sorted(p for p, _ in _scan_files(folder)), tmp_path)
+        os.replace(tmp_path, zip_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return stats
+
+def record_archive_stats(source: str, job_id, stats: dict, share_id: str = None):
+    """Пишет статистику сборки архива задачи, чтобы подбирать баланс CPU/трафик"""
+    entry = {"ts": int(time.time()), "source": source, "job_id": job_id, "share_id": share_id, **stats}
+    logging.info(f"Archive built: {entry}")
+    try:
+        os.makedirs(os.path.dirname(ARCHIVE_STATS_FILE) or ".", exist_ok=True)
+        with open(ARCHIVE_STATS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        logging.warning(f"Не удалось записать статистику архива: {e}")
+
+def _results_note(job: Job) -> str:
+    note = ""
+    if job.validation:
+        note += f"\nАккаунтов: {job.validation['accounts']} (с парой .session+.json: {job.validation['paired']})"
+        if job.validation["invalid"]:
+            note += f"\nБитых файлов отброшено: {job.validation['invalid']} (см. {MANIFEST_NAME})"
+    if job.duplicates:
+        note += f"\nДубликатов отброшено: {job.duplicates}"
+    return note
+
+def _count_results(files) -> int:
+    """Файлы аккаунтов без служебного манифеста"""
+    return sum(1 for f in files if f.name != MANIFEST_NAME)
+
+async def send_results_document(job: Job, final_files, total_bytes: int) -> bool:
+    """Небольшой результат: zip в памяти и send_document, без share-папки и ссылки"""
+    if not DIRECT_DELIVERY_MAX_BYTES or total_bytes > DIRECT_DELIVERY_MAX_BYTES:
+        return False
+    try:
+        with span("zip_build", files=len(final_files)) as zip_span:
+            data, stats = await asyncio.to_thread(build_zip_bytes, final_files)
+            zip_span.set(bytes=stats["raw_bytes"], zip_bytes=stats["zip_bytes"], policy=stats["policy"])
+        await fs.run(record_archive_stats, "direct", job.job_id, stats)
+        if len(data) > DIRECT_DELIVERY_MAX_BYTES:
+            return False
+        await bot.send_document(
+            job.chat_id,
+            BufferedInputFile(data, filename=f"accounts_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"),
+            caption=f"Готово! Файлов: {_count_results(final_files)}{_results_note(job)}",
+        )
+        return True
+    except Exception as e:
+        # Не получилось отправить документом — отдаём по ссылке
+        logging.warning(f"Direct delivery failed for job {job.job_id}: {e}")
+        return False
+
+async def deliver_results(job: Job, user_output_dir: Path):
+    user_id = job.user_id
+    if job.validation is None:
+        # Задача продолжена после рестарта — итоги проверки берём из манифеста
+        job.validation = await fs.run(_load_validation_summary, user_output_dir)
+    scanned = await fs.scan_files(user_output_dir, TARGET_SUFFIXES)
+    final_files = [f for f, _ in scanned]
+    total_bytes = sum(size for _, size in scanned)
+
+    if not _count_results(final_files):
+        await job.notify(f"Готово! Но не найдено файлов .json или .session.{_results_note(job)}")
+    elif await send_results_document(job, final_files, total_bytes):
+        return
     else:
         share_id = str(uuid.uuid4())
         share_folder = Path("/app/share") / user_id / share_id
-        share_folder.mkdir(parents=True, exist_ok=True)
-        for f in final_files:
-            shutil.copy(f, share_folder / f.name)
+        with span("share_build", files=len(final_files), bytes=total_bytes):
+            await fs.copy_files(final_files, share_folder)
 
-        # Удаление через 30 минут
-        async def delayed_cleanup(folder, delay=1800):
-            await asyncio.sleep(delay)
-            try:
-                shutil.rmtree(folder)
-                zip_path = folder.with_suffix(".zip")
-                if zip_path.exists():
-                    zip_path.unlink()
-                logging.info(f"Удалена временная папка и zip: {folder}")
-            except Exception as e:
-                logging.error(f"Ошибка при удалении: {str(e)}")
-
-        asyncio.create_task(delayed_cleanup(share_folder))
+        # Удаление через SHARE_TTL: срок хранится в общей базе, папку удалит любой инстанс
+        expires_ts = int(time.time()) + SHARE_TTL
+        await asyncio.to_thread(state_db.share_register, str(share_folder), expires_ts, job.job_id)
 
-        remaining_seconds = 30 * 60
+        remaining_seconds = SHARE_TTL
         minutes = remaining_seconds // 60
         seconds = remaining_seconds % 60
         countdown_str = f"{minutes:02}:{seconds:02}"
 
-        download_link = f"https://{os.getenv('RAILWAY_STATIC_URL')}/download/{user_id}/{share_id}"
-        archive_message = await message.reply(
-            f"Готово! Вот ссылка для скачивания ZIP-архива:\n{download_link}\n\n"
+        download_link = f"https://{os.getenv('RAILWAY_STATIC_URL')}{make_download_path(user_id, share_id, expires_ts)}"
+        archive_message = await job.notify(
+            f"Готово! Вот ссылка для скачивания ZIP-архива:\n{download_link}{_results_note(job)}\n\n"
             f"⏳ До удаления архива: {countdown_str}"
         )
         # Обновление сообщения каждые 30 секунд с обратным отсчётом
@@ -533,21 +2782,186 @@ async def process_link(message: types.Message, state: FSMContext):
                 seconds = sec % 60
                 countdown_str = f"{minutes:02}:{seconds:02}"
                 try:
-                    await msg.edit_text(
-                        f"Готово! Вот ссылка для скачивания ZIP-архива:\n{download_link}\n\n"
-                        f"⏳ До удаления архива: {countdown_str}"
-                    )
+                    with span("telegram_edit"):
+                        await msg.edit_text(
+                            f"Готово! Вот ссылка для скачивания ZIP-архива:\n{download_link}{_results_note(job)}\n\n"
+                            f"⏳ До удаления архива: {countdown_str}"
+                        )
                 except Exception as e:
                     logging.warning(f"Не удалось обновить сообщение: {e}")
                     break
                 await asyncio.sleep(30)  # Ждем 30 секунд между обновлениями
 
+        await job.checkpoint(link_message_id=archive_message.message_id)
         asyncio.create_task(update_countdown(archive_message, remaining_seconds))
         buttons = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="📥 Скачать снова", url=download_link)],
             [InlineKeyboardButton(text="🗑 Удалить архив", callback_data="delete_last")]
         ])
-        await message.reply("Что хотите сделать дальше?", reply_markup=buttons)
+        await job.notify("Что хотите сделать дальше?", reply_markup=buttons)
+
+# Подхватываем задачи, прерванные рестартом или падением инстанса
+async def resume_interrupted_jobs():
+    records = await asyncio.to_thread(state_db.jobs_by_status, "running")
+    for rec in records:
+        if rec["user_id"] in active_jobs:
+            continue
+        job = Job.from_record(rec)
+        # Пока аренда предыдущего владельца не истекла, задача считается живой
+        if not await job_locks.acquire(job.lock_name, job.lock_owner):
+            continue
+        if WORKER_PROCESSES:
+            # Задачи выполняют воркеры — возвращаем в очередь. worker отмечает, что задача
+            # уже выполнялась: воркер не станет чистить её папки
+            await asyncio.to_thread(
+                state_db.job_update, job.job_id, status="queued", worker=rec["worker"] or INSTANCE_ID
+            )
+            await job_locks.release(job.lock_name, job.lock_owner)
+            logging.info(f"Requeued interrupted job {job.job_id} of user {job.user_id}")
+            continue
+        logging.info(f"Resuming job {job.job_id} of user {job.user_id} from stage {job.stage}")
+        start_job(job, "♻️ Бот был перезапущен — продолжаю обработку ваших ссылок")
+
+async def job_resume_loop():
+    while not shutdown_event.is_set():
+        try:
+            await resume_interrupted_jobs()
+            await asyncio.to_thread(state_db.jobs_prune, int(time.time()) - JOB_JOURNAL_RETENTION)
+        except Exception as e:
+            logging.error(f"Ошибка при возобновлении задач: {e}")
+        await asyncio.sleep(JOB_RESUME_INTERVAL)
+
+# Корректная остановка: ждём задачи SHUTDOWN_GRACE секунд, остальные сохраняем в журнале
+async def shutdown_jobs():
+    jobs = [job for job in active_jobs.values() if job.task]
+    if not jobs:
+        return
+    logging.info(f"Shutdown: waiting up to {SHUTDOWN_GRACE}s for {len(jobs)} job(s)")
+    _, pending = await asyncio.wait([job.task for job in jobs], timeout=SHUTDOWN_GRACE)
+    for job in jobs:
+        if job.task in pending:
+            job.cancel("shutdown")
+    if pending:
+        await asyncio.wait(pending, timeout=10)
+
+# --- Режим с процессами-воркерами (WORKER_PROCESSES > 0) ---
+
+async def enqueue_job(message: types.Message, job: Job):
+    """Ставит задачу в очередь журнала — её заберёт свободный воркер"""
+    try:
+        queued = await asyncio.to_thread(state_db.job_enqueue, job.record(status="queued"))
+    except Exception as e:
+        logging.error(f"Не удалось поставить задачу в очередь: {e}")
+        await message.reply(f"Ошибка: {str(e)}")
+        return
+    if not queued:
+        await message.reply("У вас уже выполняется задача. Дождитесь её завершения или отправьте /cancel.")
+        return
+    await message.reply(f"📥 Ссылок принято: {len(job.links)}. Задача в очереди на обработку.")
+
+async def worker_main():
+    """Процесс-воркер: по одной берёт задачи из очереди в журнале и выполняет их"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            pass
+    logging.info(f"Worker {WORKER_INDEX} started as {INSTANCE_ID}")
+    # /profile фронтенда приходит воркерам через журнал
+    profile_watch = asyncio.create_task(worker_profile_watch())
+
+    while not shutdown_event.is_set():
+        try:
+            rec = await asyncio.to_thread(state_db.job_claim, INSTANCE_ID, JOB_LOCK_TTL)
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось взять задачу из очереди: {e}")
+            rec = None
+        if rec is None:
+            try:
+                await asyncio.wait_for(shutdown_event.wait(), WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job = Job.from_record(rec)
+        logging.info(f"Worker {WORKER_INDEX} took job {job.job_id} of user {job.user_id} at stage {job.stage}")
+        if rec["resumed"]:
+            progress_text = "♻️ Продолжаю обработку ваших ссылок"
+        else:
+            progress_text = f"⏳ Обрабатываю ссылок: {len(job.links)}"
+            try:
+                # Удаляем старые файлы перед началом новой загрузки
+                await fs.reset_dir(Path(OUTPUT_DIR) / job.user_id)
+                await fs.reset_dir(job.workspace)
+            except Exception as e:
+                logging.error(f"Не удалось подготовить папки задачи {job.job_id}: {e}")
+                await asyncio.to_thread(state_db.job_update, job.job_id, status="failed", links=[])
+                await job_locks.release(job.lock_name, job.lock_owner)
+                continue
+        start_job(job, progress_text)
+        # Флаг отмены в журнале задача проверяет сама (_job_cancel_watch)
+        while not job.task.done() and not shutdown_event.is_set():
+            await asyncio.wait({job.task}, timeout=WORKER_POLL_INTERVAL)
+
+    profiler.stop()
+    profile_watch.cancel()
+    await shutdown_jobs()
+    await close_http_session()
+    await bot.session.close()
+
+
+class WorkerSupervisor:
+    """Держит WORKER_PROCESSES процессов-воркеров. Упавший воркер перезапускается,
+    его внешние процессы завершаются, а задачи сразу возвращаются в очередь,
+    не дожидаясь истечения аренды.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.procs = {}
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._keep_alive(index)) for index in range(self.count)]
+
+    async def _keep_alive(self, index: int):
+        backoff = 1
+        while not shutdown_event.is_set():
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-u", os.path.abspath(__file__), "--worker", str(index),
+                env={**os.environ, "INSTANCE_ID": INSTANCE_ID},
+            )
+            self.procs[index] = proc
+            returncode = await proc.wait()
+            if shutdown_event.is_set():
+                break
+            worker = worker_instance_id(INSTANCE_ID, proc.pid)
+            # Внешние команды запущены в своих сессиях и переживают воркер: добиваем их,
+            # иначе они продолжат писать в папку, которую займёт следующий воркер
+            kill_process_groups(await asyncio.to_thread(state_db.worker_job_pids, worker))
+            requeued = await asyncio.to_thread(state_db.jobs_requeue_worker, worker)
+            logging.error(f"Worker {index} (pid {proc.pid}) exited with code {returncode}; requeued jobs: {requeued}")
+            # Воркер, падающий сразу после старта, перезапускаем с растущей паузой
+            backoff = 1 if time.monotonic() - started > 60 else min(backoff * 2, 60)
+            await asyncio.sleep(backoff)
+
+    async def stop(self):
+        """SIGTERM воркерам: они ждут задачи SHUTDOWN_GRACE секунд и сохраняют остальные в журнале"""
+        procs = [proc for proc in self.procs.values() if proc.returncode is None]
+        for proc in procs:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        if procs:
+            await asyncio.wait([asyncio.create_task(proc.wait()) for proc in procs], timeout=SHUTDOWN_GRACE + 15)
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+        for task in self.tasks:
+            task.cancel()
 
 # Команда /pay
 @dp.message(Command(commands=['pay']))
@@ -709,6 +3123,188 @@ async def revoke_command(message: types.Message):
         logging.error(f"Ошибка в команде /revoke: {e}")
         await message.reply("❌ Ошибка при обработке команды")
 
+async def collect_worker_profiles(run_id, own_paths, own_error):
+    """Ждёт результаты воркеров по запуску run_id и сводит их с результатом этого процесса"""
+    deadline = time.monotonic() + PROFILE_COLLECT_TIMEOUT
+    results = []
+    while time.monotonic() < deadline:
+        results = await asyncio.to_thread(state_db.profile_results, run_id)
+        if len(results) >= WORKER_PROCESSES:
+            break
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+    if len(results) < WORKER_PROCESSES:
+        logging.warning(f"Profile run {run_id}: {len(results)} of {WORKER_PROCESSES} workers reported")
+    parts = [("main", own_paths, own_error)] + [
+        (r["process"], (r["collapsed"], r["alloc"]) if r["collapsed"] else None, r["error"]) for r in results
+    ]
+    merged = await asyncio.to_thread(merge_profiles, parts)
+    profiler.last_result = merged
+    return merged
+
+async def send_profile_results(future, run_id=None):
+    """Дожидается конца профилирования (и воркеров, если run_id) и отправляет файлы админу (если ADMIN_ID задан)"""
+    try:
+        paths = await future
+    except Exception as e:
+        logging.error(f"Профилирование не удалось: {e}")
+        paths, error = None, e
+    else:
+        error = None
+    if run_id is not None:
+        try:
+            paths, error = await collect_worker_profiles(run_id, paths, error), None
+        except Exception as e:
+            logging.error(f"Не удалось собрать профили воркеров: {e}")
+        finally:
+            profiler.run_id = None
+    if not ADMIN_ID:
+        # Запуск через HTTP без админа в Telegram: результат доступен по GET /admin/profile/{kind}
+        return
+    try:
+        if error:
+            await bot.send_message(ADMIN_ID, f"❌ Профилирование не удалось: {error}")
+            return
+        for path in paths:
+            await bot.send_document(ADMIN_ID, FSInputFile(path))
+    except Exception as e:
+        logging.warning(f"Не удалось отправить результаты профилирования: {e}")
+
+async def start_profiling(seconds: float) -> bool:
+    future = profiler.start(seconds, asyncio.get_running_loop())
+    if future is None:
+        return False
+    run_id = None
+    if WORKER_PROCESSES:
+        # Задачи выполняют воркеры — профилируем и их
+        try:
+            run_id = await asyncio.to_thread(state_db.profile_request, min(max(seconds, 1), PROFILE_MAX_SECONDS))
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось передать профилирование воркерам: {e}")
+    profiler.run_id = run_id
+    asyncio.create_task(send_profile_results(future, run_id))
+    return True
+
+async def stop_profiling() -> bool:
+    if profiler.run_id is not None:
+        try:
+            await asyncio.to_thread(state_db.profile_request_stop, profiler.run_id)
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось остановить профилирование воркеров: {e}")
+    return profiler.stop()
+
+async def _worker_profile_run(run):
+    """Профилирование воркера по запуску из журнала; результат — обратно в журнал"""
+    future = profiler.start(run["seconds"], asyncio.get_running_loop())
+    if future is None:
+        await asyncio.to_thread(state_db.profile_result_save, run["run_id"], INSTANCE_ID, error="already running")
+        return
+    while not future.done():
+        await asyncio.wait({future}, timeout=WORKER_POLL_INTERVAL)
+        if not future.done():
+            current = await asyncio.to_thread(state_db.profile_run, run["run_id"])
+            if current and current["stop_requested"]:
+                profiler.stop()
+    try:
+        collapsed, alloc = future.result()
+    except Exception as e:
+        await asyncio.to_thread(state_db.profile_result_save, run["run_id"], INSTANCE_ID, error=str(e))
+    else:
+        await asyncio.to_thread(
+            state_db.profile_result_save, run["run_id"], INSTANCE_ID, str(collapsed), str(alloc)
+        )
+
+async def worker_profile_watch():
+    """Воркер: следит за новыми запусками профилирования в журнале"""
+    try:
+        run = await asyncio.to_thread(state_db.profile_run)
+    except sqlite3.Error:
+        run = None
+    # Запуски до старта воркера не выполняем
+    seen = run["run_id"] if run else 0
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), WORKER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            run = await asyncio.to_thread(state_db.profile_run)
+            if run and run["run_id"] > seen:
+                seen = run["run_id"]
+                if not run["stop_requested"]:
+                    await _worker_profile_run(run)
+        except Exception as e:
+            logging.error(f"Ошибка профилирования воркера: {e}")
+
+@dp.message(Command(commands=['profile']))
+async def profile_command(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply("❌ Недостаточно прав")
+        return
+
+    command_parts = message.text.split()
+    if len(command_parts) == 2 and command_parts[1] == "stop":
+        if await stop_profiling():
+            await message.reply("⏹ Профилирование остановлено, файлы придут следом")
+        else:
+            await message.reply("Профилирование не запущено")
+        return
+    try:
+        seconds = int(command_parts[1]) if len(command_parts) > 1 else 30
+    except ValueError:
+        await message.reply("Использование: /profile <seconds> или /profile stop")
+        return
+    if await start_profiling(seconds):
+        await message.reply(f"▶️ Профилирование на {min(seconds, PROFILE_MAX_SECONDS)} сек запущено")
+    else:
+        await message.reply("Профилирование уже идёт")
+
+def _format_bytes(n: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГБ"
+
+@dp.message(Command(commands=['slowjobs']))
+async def slowjobs_command(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply("❌ Недостаточно прав")
+        return
+
+    command_parts = message.text.split()
+    try:
+        limit = int(command_parts[1]) if len(command_parts) > 1 else 5
+    except ValueError:
+        await message.reply("Использование: /slowjobs [N]")
+        return
+    recent = await asyncio.to_thread(state_db.jobs_traced, TRACE_RECENT_JOBS)
+    jobs = sorted(recent, key=lambda r: r["duration"], reverse=True)[:max(1, min(limit, 20))]
+    if not jobs:
+        await message.reply("Завершённых задач с трассой пока нет")
+        return
+
+    lines = []
+    for rec in jobs:
+        started = datetime.fromtimestamp(rec["start"]).strftime("%d.%m %H:%M")
+        lines.append(
+            f"🐢 {rec['trace_id'][:8]} · user {rec['user_id']} · {started} · "
+            f"{rec['duration']:.1f} с · {rec['status']} · ссылок: {rec['links']}"
+        )
+        stages = sorted(rec["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for name, stage in stages:
+            line = f"   {name}: {stage['seconds']:.1f} с ×{stage['count']}"
+            if stage["bytes"]:
+                line += f", {_format_bytes(stage['bytes'])}"
+            lines.append(line)
+    await message.reply("\n".join(lines)[:4000])
+
+@dp.message(Command(commands=['cancel']))
+async def cancel_command(message: types.Message):
+    if await cancel_user_job(str(message.from_user.id)):
+        await message.reply("Текущая задача остановлена.")
+    else:
+        await message.reply("Нет активной задачи.")
+
 @dp.message()
 async def fallback(message: types.Message):
     await message.reply("Используй команду /start и отправь ссылки на MEGA.")
@@ -719,19 +3315,18 @@ async def handle_upload_more(callback_query: CallbackQuery, state: FSMContext):
     await state.set_state(DownloadState.waiting_for_link)
     await callback_query.answer()
 
+@dp.callback_query(lambda c: c.data == "cancel_job")
+async def handle_cancel_job(callback_query: CallbackQuery):
+    if await cancel_user_job(str(callback_query.from_user.id)):
+        await callback_query.answer("Останавливаю задачу…")
+    else:
+        await callback_query.answer("Нет активной задачи")
+
 @dp.callback_query(lambda c: c.data == "delete_last")
 async def handle_delete_last(callback_query: CallbackQuery):
-    import shutil
-    from glob import glob
-
     # Удаляем архивы .zip, связанные с пользователем
     user_id = str(callback_query.from_user.id)
-    user_zip_dir = Path("/app/share") / user_id
-    for zip_file in user_zip_dir.glob("**/*.zip"):
-        try:
-            zip_file.unlink()
-        except Exception as e:
-            logging.warning(f"Не удалось удалить архив: {zip_file} — {e}")
+    await fs.unlink_matching(Path("/app/share") / user_id, ".zip")
 
     try:
         await callback_query.message.delete()
@@ -739,32 +3334,39 @@ async def handle_delete_last(callback_query: CallbackQuery):
         logging.warning(f"Не удалось удалить сообщение: {str(e)}")
 
     # Удаляем сообщение со ссылкой, если возможно
-    async for msg in callback_query.message.chat.get_history(limit=5):
-        if msg.text and "ссылка для скачивания" in msg.text:
-            try:
-                await msg.delete()
-                break
-            except Exception as e:
-                logging.warning(f"Не удалось удалить сообщение со ссылкой: {str(e)}")
+    link_message_id = await asyncio.to_thread(state_db.pop_link_message, user_id)
+    if link_message_id:
+        try:
+            await bot.delete_message(callback_query.message.chat.id, link_message_id)
+        except Exception as e:
+            logging.warning(f"Не удалось удалить сообщение со ссылкой: {str(e)}")
 
-    user_folder = Path("/app/аккаунт") / user_id
-    share_folder = Path("/app/share") / user_id
     try:
-        if user_folder.exists():
-            shutil.rmtree(user_folder)
-        if share_folder.exists():
-            shutil.rmtree(share_folder)
-        zip_files = list(Path("/app/share") / user_id).glob("**/*.zip")
-        for zip_file in zip_files:
-            try:
-                zip_file.unlink()
-            except Exception as e:
-                logging.warning(f"Не удалось удалить zip-файл: {zip_file} — {e}")
+        await fs.rmtree(Path(OUTPUT_DIR) / user_id)
+        await fs.rmtree(Path("/app/share") / user_id)
         await callback_query.message.answer("Последние файлы и архивы удалены.")
     except Exception as e:
         await callback_query.message.answer(f"Ошибка при удалении: {str(e)}")
     await callback_query.answer()
 
+def _remove_share(folder: Path):
+    shutil.rmtree(folder, ignore_errors=True)
+    zip_path = folder.with_suffix(".zip")
+    if zip_path.exists():
+        zip_path.unlink()
+
+# Периодически удаляем просроченные share-папки (срок переживает рестарт)
+async def share_sweeper():
+    while True:
+        try:
+            expired = await asyncio.to_thread(state_db.share_pop_expired, int(time.time()))
+            for path in expired:
+                await fs.run(_remove_share, Path(path))
+                logging.info(f"Удалена временная папка и zip: {path}")
+        except Exception as e:
+            logging.error(f"Ошибка при удалении: {str(e)}")
+        await asyncio.sleep(SHARE_SWEEP_INTERVAL)
+
 async def main():
     _ensure_licenses_file_writable()
     try:
@@ -788,14 +3390,58 @@ async def main():
     async def handle_download(request):
         token1 = request.match_info.get("token1")
         token2 = request.match_info.get("token2")
-        folder = Path("/app/share") / token1 / token2
+        # Подпись и срок проверяем до любого доступа к диску.
+        # Отказ не зависит от состояния сервера, поэтому прокси/CDN может его кэшировать.
+        share_id, error = verify_download_token(token1, token2)
+        if error:
+            status, text = error
+            return web.Response(status=status, text=text, headers={"Cache-Control": "public, max-age=86400"})
+        folder = Path("/app/share") / token1 / share_id
         if folder.exists() and folder.is_dir():
             zip_path = folder.with_suffix(".zip")
             if not zip_path.exists():
-                shutil.make_archive(str(zip_path.with_suffix("")), 'zip', folder)
-            return web.FileResponse(path=zip_path)
+                with span("share_zip", trace_id=share_id) as zip_span:
+                    stats = await fs.run(build_share_zip, folder, zip_path)
+                    zip_span.set(bytes=stats["raw_bytes"], zip_bytes=stats["zip_bytes"], files=stats["files"])
+                job_id = await asyncio.to_thread(state_db.share_job, str(folder))
+                await fs.run(record_archive_stats, "share", job_id, stats, share_id)
+            return web.FileResponse(path=zip_path, headers={"Cache-Control": "private, no-store"})
         return web.Response(status=404, text="Not found")
 
+    def admin_authorized(request) -> bool:
+        token = request.headers.get("X-Admin-Token", "")
+        return bool(ADMIN_API_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode())
+
+    # Профилирование: POST ?seconds=N — старт, DELETE — досрочная остановка,
+    # GET — состояние, GET /admin/profile/{collapsed|alloc} — последний результат
+    async def handle_profile(request):
+        if not admin_authorized(request):
+            return web.Response(status=403, text="Forbidden")
+        if request.method == "POST":
+            try:
+                seconds = int(request.query.get("seconds", "30"))
+            except ValueError:
+                return web.Response(status=400, text="Invalid seconds")
+            if not await start_profiling(seconds):
+                return web.json_response({"status": "running"}, status=409)
+            return web.json_response({"status": "started", "seconds": min(seconds, PROFILE_MAX_SECONDS)}, status=202)
+        if request.method == "DELETE":
+            return web.json_response({"status": "stopping" if await stop_profiling() else "idle"})
+        return web.json_response({
+            "status": "running" if profiler.running else "idle",
+            "started_at": profiler.started_at,
+            "last_result": [p.name for p in profiler.last_result] if profiler.last_result else None,
+        })
+
+    async def handle_profile_result(request):
+        if not admin_authorized(request):
+            return web.Response(status=403, text="Forbidden")
+        kinds = {"collapsed": 0, "alloc": 1}
+        kind = request.match_info.get("kind")
+        if kind not in kinds or not profiler.last_result:
+            return web.Response(status=404, text="Not found")
+        return web.FileResponse(path=profiler.last_result[kinds[kind]], headers={"Cache-Control": "private, no-store"})
+
     # Обработчик для health check
     async def handle_health(request):
         return web.Response(text="ok")
@@ -829,7 +3475,7 @@ async def main():
             if STRIPE_TRIAL_DAYS > 0:
                 session_kwargs['subscription_data']['trial_period_days'] = STRIPE_TRIAL_DAYS
 
-            checkout_session = stripe.checkout.Session.create(**session_kwargs)
+            checkout_session = stripe_call("checkout.Session.create", stripe.checkout.Session.create, **session_kwargs)
             
             logging.info(f"Created checkout session for user {user_id}: {checkout_session.id}")
             return web.HTTPFound(location=checkout_session.url)
@@ -840,6 +3486,10 @@ async def main():
 
     # Обработчик для Stripe webhooks
     async def handle_stripe_webhook(request):
+        with span("stripe_webhook"):
+            return await _handle_stripe_webhook(request)
+
+    async def _handle_stripe_webhook(request):
         try:
             payload = await request.text()
             sig_header = request.headers.get('stripe-signature')
@@ -856,6 +3506,7 @@ async def main():
                 logging.error(f"Invalid signature: {e}")
                 return web.Response(status=400, text="Invalid signature")
             
+            trace_set(event=event['type'])
             # Обрабатываем события
             if event['type'] == 'checkout.session.completed':
                 session = event['data']['object']
@@ -865,7 +3516,7 @@ async def main():
 
                 if subscription_id:
                     # Получаем информацию о подписке
-                    subscription = stripe.Subscription.retrieve(subscription_id)
+                    subscription = stripe_call("Subscription.retrieve", stripe.Subscription.retrieve, subscription_id)
                     expires_ts = compute_expires_ts_from_subscription(subscription)
 
                     if user_id:
@@ -885,7 +3536,7 @@ async def main():
                             cust_id = session.get('customer')
                             if cust_id:
                                 try:
-                                    cust = stripe.Customer.retrieve(cust_id)
+                                    cust = stripe_call("Customer.retrieve", stripe.Customer.retrieve, cust_id)
                                     email = (cust.get('email') or '').strip() if isinstance(cust, dict) else None
                                 except Exception as e:  # не фейлим обработку
                                     logging.warning(f"Unable to retrieve customer {cust_id}: {e}")
@@ -894,6 +3545,7 @@ async def main():
                             licenses.setdefault('pending_by_email', {})
                             licenses['pending_by_email'][email] = expires_ts
                             save_licenses(licenses)
+                            license_scheduler.schedule_pending(email, expires_ts)
                             logging.info(f"Stored pending license by email {email} until {expires_ts}; user can run /link {email}")
                         else:
                             logging.warning("checkout.session.completed without user_id and email – cannot link automatically")
@@ -913,26 +3565,27 @@ async def main():
                             cust_id = invoice.get('customer')
                             if cust_id:
                                 try:
-                                    cust = stripe.Customer.retrieve(cust_id)
+                                    cust = stripe_call("Customer.retrieve", stripe.Customer.retrieve, cust_id)
                                     email = (cust.get('email') or '').strip() if isinstance(cust, dict) else None
                                 except Exception as e:
                                     logging.warning(f"Unable to retrieve customer {cust_id}: {e}")
                         if email:
                             # если ранее мы сохранили pending_by_email, активируем по команде /link; здесь просто кэшируем срок
                             try:
-                                subscription = stripe.Subscription.retrieve(subscription_id)
+                                subscription = stripe_call("Subscription.retrieve", stripe.Subscription.retrieve, subscription_id)
                                 expires_ts = compute_expires_ts_from_subscription(subscription)
                                 licenses = load_licenses()
                                 licenses.setdefault('pending_by_email', {})
                                 licenses['pending_by_email'][email] = expires_ts
                                 save_licenses(licenses)
+                                license_scheduler.schedule_pending(email, expires_ts)
                                 logging.info(f"Stored pending license by email {email} until {expires_ts} (awaiting /link {email})")
                             except Exception as e:
                                 logging.warning(f"Failed to cache pending license for {email}: {e}")
 
                     if user_id:
                         # Получаем обновленную информацию о подписке
-                        subscription = stripe.Subscription.retrieve(subscription_id)
+                        subscription = stripe_call("Subscription.retrieve", stripe.Subscription.retrieve, subscription_id)
                         expires_ts = compute_expires_ts_from_subscription(subscription)
                         # Обновляем лицензию
                         update_user_license(user_id, expires_ts)
@@ -954,6 +3607,7 @@ async def main():
                         if user_id_str in licenses["users"]:
                             licenses["users"][user_id_str]["grace_until"] = grace_until
                             save_licenses(licenses)
+                            license_scheduler.schedule_user(user_id_str, licenses["users"][user_id_str])
                             
                         logging.info(f"Payment failed for user {user_id}, grace period until {grace_until}")
             
@@ -991,6 +3645,8 @@ async def main():
     app.router.add_get("/webhooks/stripe", handle_health)  # returns 200 on GET for quick checks
     app.router.add_get("/webhooks/stripe/", handle_health)
     app.router.add_get("/download/{token1}/{token2}", handle_download)
+    app.router.add_route("*", "/admin/profile", handle_profile)
+    app.router.add_get("/admin/profile/{kind}", handle_profile_result)
 
     # Success/Cancel landing pages to avoid 404 after checkout
     async def handle_pay_success(request):
@@ -1012,14 +3668,44 @@ async def main():
     site = web.TCPSite(runner, port=port)
     await site.start()
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    # Start Telegram long-polling in background (single instance on Railway)
-    asyncio.create_task(dp.start_polling(bot))
+    asyncio.create_task(share_sweeper())
 
-    # Stay alive
-    await asyncio.Event().wait()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            pass
+
+    if TELEGRAM_POLLING:
+        # Обновления, пришедшие во время рестарта, не сбрасываем — их обработает новый процесс
+        await bot.delete_webhook(drop_pending_updates=False)
+        asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    else:
+        logging.info("Telegram polling disabled (TELEGRAM_POLLING=0)")
+    asyncio.create_task(job_resume_loop())
+    asyncio.create_task(license_scheduler.run())
+    supervisor = None
+    if WORKER_PROCESSES:
+        supervisor = WorkerSupervisor(WORKER_PROCESSES)
+        supervisor.start()
+
+    # Stay alive until SIGTERM/SIGINT
+    await shutdown_event.wait()
+    logging.info("Shutdown requested")
+    if TELEGRAM_POLLING:
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            pass
+    await shutdown_jobs()
+    if supervisor:
+        await supervisor.stop()
+    await runner.cleanup()
+    await close_http_session()
+    await bot.session.close()
 
 
 # --- Entrypoint ---
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(worker_main() if WORKER_INDEX is not None else main())
@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+# Модуль бота читает настройки при импорте: направляем все файлы во временный каталог
+_data_dir = tempfile.mkdtemp(prefix="razarhivator-tests-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN-0000000000000000000000000")
+for name, filename in (
+    ("STATE_DB_FILE", "state.sqlite3"),
+    ("LICENSES_FILE", "licenses.json"),
+    ("ARCHIVE_STATS_FILE", "archive_stats.jsonl"),
+    ("TRACE_FILE", "traces.jsonl"),
+    ("PROFILE_DIR", "profiles"),
+):
+    os.environ.setdefault(name, os.path.join(_data_dir, filename))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
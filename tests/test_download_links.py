@@ -0,0 +1,35 @@
+import time
+import uuid
+
+import pytest
+
+import razarhivator
+
+
+def _token(user_id="42", expires_ts=None):
+    share_id = str(uuid.uuid4())
+    expires_ts = expires_ts or int(time.time()) + 600
+    path = razarhivator.make_download_path(user_id, share_id, expires_ts)
+    return share_id, path.rsplit("/", 1)[1]
+
+
+def test_valid_token():
+    share_id, token = _token()
+    assert razarhivator.verify_download_token("42", token) == (share_id, None)
+
+
+def test_expired_token():
+    _, token = _token(expires_ts=int(time.time()) - 1)
+    assert razarhivator.verify_download_token("42", token) == (None, (410, "Link expired"))
+
+
+def test_token_of_other_user():
+    _, token = _token()
+    assert razarhivator.verify_download_token("43", token) == (None, (403, "Invalid link"))
+
+
+@pytest.mark.parametrize("signature", ["é" * 32, "é", "", "0" * 31, "0" * 33, "G" * 32, "00ff" * 8 + "\n"])
+def test_malformed_signature(signature):
+    share_id, token = _token()
+    prefix = token.rsplit(".", 1)[0]
+    assert razarhivator.verify_download_token("42", f"{prefix}.{signature}") == (None, (403, "Invalid link"))
@@ -0,0 +1,86 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import razarhivator
+
+
+class CountingJob(razarhivator.Job):
+    """Задача, которую отменяют после заданного числа проверок"""
+
+    def __init__(self, cancel_after):
+        super().__init__("1", 1, [])
+        self.checks = 0
+        self.cancel_after = cancel_after
+
+    def check_cancelled(self):
+        self.checks += 1
+        if self.checks > self.cancel_after:
+            self.cancel_event.set()
+        super().check_cancelled()
+
+
+def _tar_gz(path, files):
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+def test_zip_extracts_and_skips_traversal(tmp_path):
+    archive = tmp_path / "a.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("dir/acc.json", b"{}")
+        zf.writestr("../evil.json", b"{}")
+    out = tmp_path / "out"
+    out.mkdir()
+    razarhivator._extract_zip(archive, out)
+    assert (out / "dir" / "acc.json").read_bytes() == b"{}"
+    assert not (tmp_path / "evil.json").exists()
+
+
+def test_zip_cancel_inside_large_member(tmp_path):
+    archive = tmp_path / "big.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("big.bin", os.urandom(8 * 1024 * 1024))
+    out = tmp_path / "out"
+    out.mkdir()
+    # Одна проверка перед членом и две на блоках: дальше задача отменена
+    with pytest.raises(razarhivator.JobCancelled):
+        razarhivator._extract_zip(archive, out, CountingJob(cancel_after=3))
+    assert (out / "big.bin").stat().st_size == 2 * 1024 * 1024
+
+
+def test_tar_extracts_and_skips_traversal(tmp_path):
+    archive = tmp_path / "a.tar.gz"
+    _tar_gz(archive, {"acc.session": b"data", "../evil.json": b"{}"})
+    out = tmp_path / "out"
+    out.mkdir()
+    razarhivator._extract_tar_or_stream(archive, out, "gz")
+    assert (out / "acc.session").read_bytes() == b"data"
+    assert not (tmp_path / "evil.json").exists()
+
+
+def test_tar_cancel_checked_per_member_and_block(tmp_path):
+    archive = tmp_path / "a.tar.gz"
+    _tar_gz(archive, {"first.bin": os.urandom(3 * 1024 * 1024), "second.bin": b"x"})
+    out = tmp_path / "out"
+    out.mkdir()
+    with pytest.raises(razarhivator.JobCancelled):
+        razarhivator._extract_tar_or_stream(archive, out, "gz", CountingJob(cancel_after=2))
+    assert (out / "first.bin").stat().st_size == 1024 * 1024
+    assert not (out / "second.bin").exists()
+
+
+def test_tar_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(razarhivator, "MAX_UNPACK_BYTES", 10)
+    archive = tmp_path / "a.tar.gz"
+    _tar_gz(archive, {"a.json": b"x" * 8, "b.json": b"x" * 8})
+    out = tmp_path / "out"
+    out.mkdir()
+    with pytest.raises(razarhivator.UnpackLimitExceeded):
+        razarhivator._extract_tar_or_stream(archive, out, "gz")
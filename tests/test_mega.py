@@ -0,0 +1,166 @@
+import asyncio
+import base64
+import json
+import os
+import struct
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from Crypto.Cipher import AES
+from Crypto.Util import Counter as CryptoCounter
+
+import razarhivator
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _chunk_bounds(size):
+    # Границы чанков MEGA: 128К, 256К, … 1М, дальше по 1М
+    bounds, start, step = [], 0, 0x20000
+    while start < size:
+        bounds.append((start, min(start + step, size)))
+        start += step
+        step = min(step + 0x20000, 0x100000)
+    return bounds
+
+
+def _meta_mac(aes_key, nonce, plain):
+    macs = b""
+    for start, end in _chunk_bounds(len(plain)):
+        chunk = plain[start:end]
+        chunk += b"\0" * (-len(chunk) % 16)
+        macs += AES.new(aes_key, AES.MODE_CBC, iv=nonce + nonce).encrypt(chunk)[-16:]
+    mac = struct.unpack(">4I", AES.new(aes_key, AES.MODE_CBC, iv=b"\0" * 16).encrypt(macs)[-16:])
+    return mac[0] ^ mac[1], mac[2] ^ mac[3]
+
+
+class FakeMega:
+    """Публичный файл MEGA: API /cs и раздача зашифрованных диапазонов /dl/{start}-{end}"""
+
+    def __init__(self, name="result.json", size=0x100000 + 100, bad_mac=False):
+        self.plain = os.urandom(size)
+        self.name = name
+        aes_key, nonce = os.urandom(16), os.urandom(8)
+        mac = _meta_mac(aes_key, nonce, self.plain)
+        if bad_mac:
+            mac = (mac[0] ^ 1, mac[1])
+        k = struct.unpack(">4I", aes_key) + struct.unpack(">2I", nonce) + mac
+        self.key = struct.pack(">8I", *(k[i] ^ k[i + 4] for i in range(4)), *k[4:])
+        ctr = CryptoCounter.new(64, prefix=nonce, initial_value=0)
+        self.cipher = AES.new(aes_key, AES.MODE_CTR, counter=ctr).encrypt(self.plain)
+        attrs = b"MEGA" + json.dumps({"n": name}).encode()
+        attrs += b"\0" * (-len(attrs) % 16)
+        self.attrs = _b64(AES.new(aes_key, AES.MODE_CBC, iv=b"\0" * 16).encrypt(attrs))
+        # Ответы API до настоящего: (status, body)
+        self.api_failures = []
+        self.api_calls = 0
+        # Диапазоны, начиная с этого смещения, отдают 500
+        self.fail_from = None
+        self.ranges = []
+        self.server = None
+
+    @property
+    def link(self):
+        return f"https://mega.nz/file/HANDLE#{_b64(self.key)}"
+
+    async def handle_api(self, request):
+        self.api_calls += 1
+        if self.api_failures:
+            status, body = self.api_failures.pop(0)
+            return web.Response(status=status, text=body)
+        return web.json_response(
+            [{"s": len(self.plain), "at": self.attrs, "g": str(self.server.make_url("/dl"))}]
+        )
+
+    async def handle_range(self, request):
+        start, end = map(int, request.match_info["range"].split("-"))
+        self.ranges.append(start)
+        if self.fail_from is not None and start >= self.fail_from:
+            return web.Response(status=500)
+        return web.Response(body=self.cipher[start:end + 1])
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/cs", self.handle_api)
+        app.router.add_get("/dl/{range}", self.handle_range)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await razarhivator.close_http_session()
+        await self.server.close()
+
+
+@pytest.fixture
+def mega(monkeypatch):
+    fake = FakeMega()
+
+    async def download(dest_dir):
+        async with fake:
+            monkeypatch.setattr(razarhivator, "MEGA_API_URL", str(fake.server.make_url("/cs")))
+            return await razarhivator.mega_download_file(fake.link, dest_dir)
+
+    fake.download = lambda dest_dir: asyncio.run(download(dest_dir))
+    return fake
+
+
+def test_download_decrypts_and_checks_mac(mega, tmp_path):
+    path = mega.download(tmp_path)
+    assert path == tmp_path / "result.json"
+    assert path.read_bytes() == mega.plain
+    assert not (tmp_path / "result.json.part.json").exists()
+
+
+def test_bad_mac_is_rejected(monkeypatch, tmp_path):
+    fake = FakeMega(bad_mac=True)
+
+    async def download():
+        async with fake:
+            monkeypatch.setattr(razarhivator, "MEGA_API_URL", str(fake.server.make_url("/cs")))
+            await razarhivator.mega_download_file(fake.link, tmp_path)
+
+    with pytest.raises(razarhivator.MegaError, match="Контрольная сумма"):
+        asyncio.run(download())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_wrong_key_is_rejected(mega, tmp_path):
+    mega.key = bytes(32)
+    with pytest.raises(razarhivator.MegaError):
+        mega.download(tmp_path)
+
+
+def test_api_retries_transient_failures(mega, tmp_path, monkeypatch):
+    monkeypatch.setattr(razarhivator, "MEGA_RETRIES", 3)
+    mega.api_failures = [(503, "<html>Service Unavailable</html>"), (200, "[]")]
+    assert mega.download(tmp_path).read_bytes() == mega.plain
+    assert mega.api_calls == 3
+
+
+def test_api_error_code_is_final(mega, tmp_path):
+    mega.api_failures = [(200, "[-9]")]
+    with pytest.raises(razarhivator.MegaError, match="-9"):
+        mega.download(tmp_path)
+    assert mega.api_calls == 1
+
+
+def test_resume_from_part_state(mega, tmp_path, monkeypatch):
+    # Каждый чанк — отдельный диапазон, по одному за раз: до сбоя успевают первые два
+    monkeypatch.setattr(razarhivator, "MEGA_SEGMENT_BYTES", 1)
+    monkeypatch.setattr(razarhivator, "MEGA_PARALLEL_RANGES", 1)
+    monkeypatch.setattr(razarhivator, "MEGA_RETRIES", 1)
+    mega.fail_from = 0x60000
+    with pytest.raises(razarhivator.MegaError):
+        mega.download(tmp_path)
+    state = json.loads((tmp_path / "result.json.part.json").read_text())
+    assert sorted(int(k) for k in state["done"]) == [0, 0x20000]
+
+    mega.fail_from = None
+    mega.ranges = []
+    assert mega.download(tmp_path).read_bytes() == mega.plain
+    assert mega.ranges == [0x60000, 0xC0000]
+    assert not (tmp_path / "result.json.part.json").exists()
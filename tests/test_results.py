@@ -0,0 +1,66 @@
+import asyncio
+import json
+import sqlite3
+
+import razarhivator
+
+
+def _session(path, auth_key):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sessions (dc_id INTEGER, auth_key BLOB)")
+    conn.execute("INSERT INTO sessions VALUES (2, ?)", (auth_key,))
+    conn.commit()
+    conn.close()
+
+
+def _bundle(root, name, auth_key, meta):
+    root.mkdir(parents=True)
+    _session(root / f"{name}.session", auth_key)
+    (root / f"{name}.json").write_text(json.dumps(meta))
+    return [root / f"{name}.session", root / f"{name}.json"]
+
+
+def _collect(deduper, paths):
+    return [p for group in razarhivator._result_groups(paths) for p in deduper.add_group(group)]
+
+
+def _manifest(out):
+    job = razarhivator.Job("1", 1, [])
+    asyncio.run(razarhivator.validate_results(job, out))
+    return json.loads((out / razarhivator.MANIFEST_NAME).read_text())
+
+
+def test_duplicate_session_keeps_new_json_paired(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    deduper = razarhivator.ResultDeduper(out)
+    _collect(deduper, _bundle(tmp_path / "a", "acc", b"key-a", {"phone": "1"})[:1])
+    # Та же сессия, но новый json: он должен встать рядом с уже сохранённой сессией
+    _collect(deduper, _bundle(tmp_path / "b", "acc", b"key-a", {"phone": "2"}))
+    assert deduper.duplicates == 1
+    assert sorted(p.name for p in out.iterdir()) == ["acc.json", "acc.session"]
+    assert _manifest(out)["summary"] == {"accounts": 1, "paired": 1, "invalid": 0}
+
+
+def test_name_collision_renames_pair_together(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    deduper = razarhivator.ResultDeduper(out)
+    _collect(deduper, _bundle(tmp_path / "a", "acc", b"key-a", {"phone": "1"}))
+    # Та же сессия, json занят другим: пара целиком получает общий суффикс
+    _collect(deduper, _bundle(tmp_path / "b", "acc", b"key-a", {"phone": "2"}))
+    _collect(deduper, _bundle(tmp_path / "c", "acc", b"key-c", {"phone": "3"}))
+    assert sorted(p.name for p in out.iterdir()) == [
+        "acc.json", "acc.session", "acc_2.json", "acc_2.session", "acc_3.json", "acc_3.session",
+    ]
+    assert _manifest(out)["summary"] == {"accounts": 3, "paired": 3, "invalid": 0}
+
+
+def test_identical_pair_is_dropped(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    deduper = razarhivator.ResultDeduper(out)
+    _collect(deduper, _bundle(tmp_path / "a", "acc", b"key-a", {"phone": "1"}))
+    assert _collect(deduper, _bundle(tmp_path / "b", "acc", b"key-a", {"phone": "1"})) == []
+    assert deduper.duplicates == 2
+    assert sorted(p.name for p in out.iterdir()) == ["acc.json", "acc.session"]